@@ -0,0 +1,271 @@
+"""
+Differential check of the optimised builders against the reference implementations in benchmarks/reference.py.
+
+    python -m benchmarks.equivalence --cases 50 --users 40 --output equivalence.json
+
+Every case is a random portfolio, profile and transcript drawn from its own seed. The transcripts are made of the
+cases the rules are subtle for: the same offer received twice with overlapping windows, offers never viewed (nan view
+time), views before the offer, after its end and after its completion, completions in the hour the offer was received
+and in hour 0, views and completions in the same hour, offers of one type received in a row and viewed out of order
+around an unviewed one, and transactions on the window edges and one hour after the window. clean_transcript,
+build_offer_df, build_user_df and merged_intervals are run on every case by both implementations, the frames must
+match within the tolerance, and the time of both is reported side by side.
+A failing case is shrunk to the first single user that still fails and reported with its seed.
+"""
+import argparse
+import contextlib
+import io
+import json
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks import reference
+from utils.build_matrices import build_offer_df, build_user_df, merged_intervals
+from utils.cleaning import clean_data, clean_transcript
+from utils.intervals import group_coverage
+from utils.synthetic import MAX_TIME, OFFER_WAVES, generate_portfolio, generate_profile
+
+CHECKS = ['clean_transcript', 'build_offer_df', 'build_user_df', 'merged_intervals']
+# same tolerance as the spending assertion of build_user_df, amounts are stored as float32
+RTOL = 1e-5
+ATOL = 1e-3
+
+
+def random_case(seed, n_users=40):
+    """
+    Returns the raw (portfolio, profile, transcript) of a case
+    """
+    rng = np.random.default_rng(seed)
+    portfolio = generate_portfolio(rng)
+    profile = generate_profile(n_users, rng)
+    return portfolio, profile, random_transcript(portfolio, profile, rng)
+
+
+def random_transcript(portfolio, profile, rng):
+    """
+    Generates a raw transcript rich in edge cases, sorted by time with a random order of the events of an hour
+    """
+    offer_ids = np.asarray(portfolio['id'], dtype=object)
+    offer_types = np.asarray(portfolio['offer_type'], dtype=object)
+    durations = np.asarray(portfolio['duration']).astype(int) * 24
+    rewards = np.asarray(portfolio['reward']).astype(int)
+    rows = []
+
+    def add(user, event, value, hour):
+        if 0 <= hour <= MAX_TIME:
+            rows.append((user, event, value, int(hour)))
+
+    for user in profile['id']:
+        edges = []
+        for _ in range(rng.integers(0, 7)):
+            k = rng.integers(len(offer_ids))
+            start = rng.choice(OFFER_WAVES) if rng.random() < 0.7 else rng.integers(0, MAX_TIME + 1)
+            starts = [start]
+            if rng.random() < 0.2:
+                # the same offer again while the first is still running, or in the same hour
+                starts.append(start + rng.integers(0, durations[k] + 1))
+            for start in starts:
+                end = start + durations[k]
+                add(user, 'offer received', {'offer id': offer_ids[k]}, start)
+                completion = rng.choice([None, start, 0, start + rng.integers(0, durations[k] + 1),
+                                         end, end + rng.integers(1, 24)])
+                if completion is not None:
+                    add(user, 'offer completed', {'offer_id': offer_ids[k], 'reward': int(rewards[k])}, completion)
+                view_choices = [None, start, start + rng.integers(0, durations[k] + 1), end, end + 1,
+                                start - rng.integers(1, 48)]
+                if completion is not None:
+                    view_choices += [completion, completion + rng.integers(1, 24)]
+                view = view_choices[rng.integers(len(view_choices))]
+                if view is not None:
+                    add(user, 'offer viewed', {'offer id': offer_ids[k]}, view)
+                    edges += [view, view - 1, end, end + 1, end + 2]
+                if completion is not None:
+                    edges += [completion, completion + 1]
+        if rng.random() < 0.2:
+            edges += _staggered_offers(user, offer_ids, offer_types, durations, rng, add)
+        n_transactions = rng.poisson(6) if rng.random() > 0.1 else 0
+        hours = list(rng.integers(0, MAX_TIME + 1, n_transactions)) + \
+            [edge for edge in edges if rng.random() < 0.3]
+        for hour in hours:
+            add(user, 'transaction', {'amount': float(np.round(rng.lognormal(2.2, 1.0), 2))}, hour)
+
+    transcript = pd.DataFrame(rows, columns=['person', 'event', 'value', 'time'])
+    transcript = transcript.iloc[rng.permutation(len(transcript))]
+    return transcript.sort_values('time', kind='stable').reset_index(drop=True)
+
+
+def _staggered_offers(user, offer_ids, offer_types, durations, rng, add):
+    """
+    Adds three offers of one type received a few hours apart, the third viewed first, the first viewed after it and
+    the second never viewed, so the windows of the type are out of order with an unviewed offer between them
+    :return: list of the hours at the edges of the windows
+    """
+    same_type = np.flatnonzero(offer_types == offer_types[rng.integers(len(offer_ids))])
+    first, second, third = rng.choice(same_type, 3)
+    start = rng.integers(0, MAX_TIME - 100)
+    starts = start + np.array([0, rng.integers(1, 12), 0])
+    starts[2] = starts[1] + rng.integers(1, 12)
+    third_view = starts[2] + rng.integers(0, 12)
+    if third_view - starts[0] >= durations[first]:
+        return []
+    first_view = third_view + rng.integers(1, durations[first] - (third_view - starts[0]) + 1)
+    for k, offer_start in zip([first, second, third], starts):
+        add(user, 'offer received', {'offer id': offer_ids[k]}, offer_start)
+    add(user, 'offer viewed', {'offer id': offer_ids[third]}, third_view)
+    add(user, 'offer viewed', {'offer id': offer_ids[first]}, first_view)
+    return [third_view, first_view, starts[0] + durations[first], starts[2] + durations[third]]
+
+
+def run_case(portfolio, profile, transcript, timings=None):
+    """
+    Runs every check on a case
+    :param timings: dict of check name to [reference seconds, optimised seconds] to add the times to
+    :return: dict of check name to the mismatch message, empty if everything matched
+    """
+    timings = {} if timings is None else timings
+    failures = {}
+
+    def compare(name, reference_func, optimised_func, normalise):
+        expected, reference_seconds = _timed(reference_func)
+        actual, optimised_seconds = _timed(optimised_func)
+        times = timings.setdefault(name, [0.0, 0.0])
+        times[0] += reference_seconds
+        times[1] += optimised_seconds
+        try:
+            pd.testing.assert_frame_equal(normalise(actual), normalise(expected), check_dtype=False,
+                                          check_exact=False, rtol=RTOL, atol=ATOL)
+        except AssertionError as error:
+            failures[name] = str(error)
+        return expected
+
+    compare('clean_transcript', lambda: reference.clean_transcript(transcript), lambda: clean_transcript(transcript),
+            _comparable)
+    portfolio, profile, transcript = clean_data(portfolio, profile, transcript)
+    offer_df = compare('build_offer_df', lambda: reference.build_offer_df(portfolio, profile, transcript),
+                       lambda: build_offer_df(portfolio, profile, transcript), _comparable)
+    # without any view or completion the reference keeps None in an object column, which its merging cannot sort
+    offer_df = offer_df.astype({'view_time': float, 'complet_time': float})
+    compare('build_user_df', lambda: reference.build_user_df(portfolio, profile, transcript, offer_df),
+            lambda: build_user_df(portfolio, profile, transcript, offer_df),
+            lambda df: _comparable(df.sort_values('user_id')))
+    return failures
+
+
+def check_merged_intervals(rng, n_groups=200, timings=None):
+    """
+    Compares the covered time of random windows by the reference merged_intervals, merged_intervals and
+    group_coverage. Windows are nested, touching, duplicated or disjoint, and some are nan.
+    :return: mismatch message, None if all agree
+    """
+    groups = np.repeat(np.arange(n_groups), rng.integers(0, 8, n_groups))
+    starts = rng.integers(0, 100, len(groups)).astype(float)
+    ends = starts + rng.integers(0, 40, len(groups))
+    starts[rng.random(len(groups)) < 0.1] = np.nan
+    windows = [list(zip(starts[groups == group], ends[groups == group])) for group in range(n_groups)]
+    valid = [[(s, e) for s, e in group_windows if not np.isnan(s)] for group_windows in windows]
+
+    def covered(func, windows):
+        return np.array([np.diff(np.array(func(list(w))).transpose(), axis=0).sum() for w in windows])
+
+    # the reference sorts nan start times into the list, it is given the windows of viewed offers only
+    expected, reference_seconds = _timed(lambda: covered(reference.merged_intervals, valid))
+    actual, optimised_seconds = _timed(lambda: group_coverage(groups, starts, ends, n_groups))
+    if timings is not None:
+        times = timings.setdefault('merged_intervals', [0.0, 0.0])
+        times[0] += reference_seconds
+        times[1] += optimised_seconds
+    for name, values in [('group_coverage', actual), ('merged_intervals', covered(merged_intervals, windows))]:
+        if not np.allclose(values, expected):
+            wrong = np.flatnonzero(~np.isclose(values, expected))[0]
+            return '{} covers {} instead of {} for windows {}'.format(name, values[wrong], expected[wrong],
+                                                                     windows[wrong])
+    return None
+
+
+def shrink(portfolio, profile, transcript):
+    """
+    Returns the id of the first user whose events alone still fail a check, None if no single user fails.
+    Users without offers are skipped, the reference cannot build an offer matrix without any offer.
+    """
+    received = transcript.loc[transcript['event'] == 'offer received', 'person']
+    for user in profile.loc[profile['id'].isin(received), 'id']:
+        single_profile = profile.loc[profile['id'] == user]
+        single_transcript = transcript.loc[transcript['person'] == user].reset_index(drop=True)
+        if run_case(portfolio, single_profile, single_transcript):
+            return user
+    return None
+
+
+def _comparable(df):
+    """
+    Returns df in common types: numbers as float, missing values as nan, other columns as str, the difficulty and
+    reward the reference kept as strings as numbers
+    """
+    df = df.reset_index(drop=True)
+    columns = {}
+    for column in sorted(df.columns):
+        values = df[column]
+        if values.dtype == bool or column.startswith(('type_', 'gender_')):
+            columns[column] = np.asarray(values, dtype=bool)
+            continue
+        numeric = pd.to_numeric(pd.Series(np.asarray(values, dtype=object)), errors='coerce')
+        if numeric.notna().sum() == values.notna().sum() and not isinstance(values.dtype, pd.DatetimeTZDtype) \
+                and not pd.api.types.is_datetime64_any_dtype(values):
+            columns[column] = numeric.astype(float).to_numpy()
+        else:
+            columns[column] = np.asarray(values.astype(object).where(values.notna(), None), dtype=object)
+    return pd.DataFrame(columns)
+
+
+def _timed(func):
+    """
+    Runs func with its printed output discarded
+    :return: (result, seconds)
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = func()
+        return result, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Checks the optimised builders against the reference builders')
+    parser.add_argument('--cases', type=int, default=20, help='number of random cases')
+    parser.add_argument('--users', type=int, default=40, help='users per case')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the first case, case k uses seed + k')
+    parser.add_argument('--output', default=None, help='json file to write the results to')
+    args = parser.parse_args(argv)
+
+    timings = {}
+    failures = []
+    for seed in range(args.seed, args.seed + args.cases):
+        portfolio, profile, transcript = random_case(seed, args.users)
+        case_failures = run_case(portfolio, profile, transcript, timings)
+        message = check_merged_intervals(np.random.default_rng(seed), timings=timings)
+        if message is not None:
+            case_failures['merged_intervals'] = message
+        if case_failures:
+            user = shrink(portfolio, profile, transcript) if set(case_failures) - {'merged_intervals'} else None
+            failures.append({'seed': seed, 'users': args.users, 'smallest_failing_user': user,
+                             'failures': case_failures})
+            print('seed {} failed {}, user {}'.format(seed, ', '.join(case_failures), user), file=sys.stderr)
+
+    print('{:<18} {:>12} {:>12} {:>9}'.format('check', 'reference s', 'optimised s', 'speed-up'))
+    for name in CHECKS:
+        reference_seconds, optimised_seconds = timings.get(name, [np.nan, np.nan])
+        print('{:<18} {:12.3f} {:12.3f} {:8.1f}x'.format(name, reference_seconds, optimised_seconds,
+                                                         reference_seconds / optimised_seconds))
+    print('{} of {} cases matched'.format(args.cases - len(failures), args.cases))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'cases': args.cases, 'users': args.users, 'seed': args.seed, 'timings': timings,
+                       'failures': failures}, f, indent=2)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+"""
+Checks the cold-start import time of utils modules against a budget.
+
+    python -m benchmarks.import_time --budget 0.3
+    python -m benchmarks.import_time utils.build_matrices utils.cleaning --budget 0.3 --output import_time.json
+
+Without module names every module of utils is checked. Every module is imported in a fresh interpreter several times
+and the fastest import counts, so the time is that of a worker process starting up with warm file system caches. The
+check fails if a module takes longer than the budget or pulls in one of the deferred dependencies (pandas, matplotlib)
+at import time.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+DEFERRED = ['pandas', 'matplotlib']
+
+PROBE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+loaded = [name for name in {deferred!r} if name in sys.modules and type(sys.modules[name]).__name__ != '_LazyModule']
+print(json.dumps({{'seconds': seconds, 'loaded': loaded}}))
+"""
+
+
+def utils_modules():
+    """
+    Returns the names of all modules of the utils package
+    """
+    directory = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'utils')
+    return ['utils.' + name[:-len('.py')] for name in sorted(os.listdir(directory))
+            if name.endswith('.py') and name != '__init__.py']
+
+
+def import_time(module, repeat=5):
+    """
+    Imports module in repeat fresh interpreters
+    :return: (fastest import in seconds, deferred dependencies executed by the import)
+    """
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, '-c', PROBE.format(module=module, deferred=DEFERRED)],
+                                check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(output))
+    return min(run['seconds'] for run in runs), sorted(set(name for run in runs for name in run['loaded']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Checks the cold-start import time of utils modules')
+    parser.add_argument('modules', nargs='*', help='modules to check, all modules of utils by default')
+    parser.add_argument('--budget', type=float, default=0.3, help='seconds allowed per module')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--output', default=None, help='json file to write the results to')
+    args = parser.parse_args(argv)
+
+    results, failures = [], []
+    for module in args.modules or utils_modules():
+        seconds, loaded = import_time(module, args.repeat)
+        results.append({'module': module, 'seconds': seconds, 'loaded': loaded, 'budget': args.budget})
+        print('{:<28} {:7.3f} s {}'.format(module, seconds, ' '.join(loaded)))
+        if seconds > args.budget:
+            failures.append('{} took {:.3f} s, budget {:.3f} s'.format(module, seconds, args.budget))
+        if loaded:
+            failures.append('{} imported {}'.format(module, ', '.join(loaded)))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if failures:
+        sys.exit('\n'.join(failures))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+"""
+Times the cleaning and matrix building pipeline on synthetic data and writes the results as json.
+
+    python -m benchmarks.run_benchmarks --events 10000 100000 1000000 --output bench.json
+
+Every stage is run twice: once for the wall time and once under tracemalloc for the peak memory allocated by the
+stage, so the memory tracing does not distort the timings.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from utils.build_matrices import build_offer_df, build_user_df, merged_intervals
+from utils.cleaning import clean_data, clean_transcript
+from utils.intervals import group_coverage
+from utils.loading import load_all
+from utils.synthetic import generate, write_json
+
+
+def measure(func, *args):
+    """
+    Runs func(*args) for the wall time and again under tracemalloc for the peak memory.
+    Output printed by the stage is discarded.
+    :return: (result, seconds, peak bytes)
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        start = time.perf_counter()
+        result = func(*args)
+        seconds = time.perf_counter() - start
+        del result
+        tracemalloc.start()
+        result = func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def run_scale(n_events, seed=0):
+    """
+    Benchmarks every stage of the pipeline on n_events synthetic events
+    :return: dict of the scale and the results of every stage
+    """
+    portfolio, profile, transcript = generate(n_events, seed=seed)
+    scale = {'events': len(transcript), 'users': len(profile), 'seed': seed}
+    stages = {}
+
+    def record(name, func, *args, rows_in=None):
+        result, seconds, peak = measure(func, *args)
+        rows_out = len(result[-1]) if isinstance(result, tuple) else len(result)
+        stages[name] = {'seconds': seconds, 'peak_bytes': peak, 'rows_in': rows_in, 'rows_out': rows_out}
+        return result
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        write_json(data_dir, portfolio, profile, transcript)
+        record('load_all', load_all, data_dir, rows_in=len(transcript))
+    record('clean_transcript', clean_transcript, transcript, rows_in=len(transcript))
+    portfolio, profile, transcript = record('clean_data', clean_data, portfolio, profile, transcript,
+                                            rows_in=len(transcript))
+    offer_df = record('build_offer_df', build_offer_df, portfolio, profile, transcript, rows_in=len(transcript))
+    record('build_user_df', build_user_df, portfolio, profile, transcript, offer_df, rows_in=len(transcript))
+
+    # window merging on its own, per user with merged_intervals and for all users at once with group_coverage
+    users = pd.Categorical(offer_df['user_id']).codes
+    starts = offer_df['view_time'].to_numpy(dtype=float, na_value=np.nan)
+    ends = starts + np.asarray(offer_df['time_in_window'])
+    order = np.argsort(users, kind='stable')
+    bounds = np.flatnonzero(np.diff(users[order])) + 1
+    windows = [list(zip(s, e)) for s, e in zip(np.split(starts[order], bounds), np.split(ends[order], bounds))]
+    record('merged_intervals', lambda: [merged_intervals(list(w)) for w in windows], rows_in=len(offer_df))
+    record('group_coverage', group_coverage, users, starts, ends, users.max() + 1, rows_in=len(offer_df))
+
+    return dict(scale, stages=stages)
+
+
+def environment():
+    """
+    Returns the versions and machine the benchmarks ran on
+    """
+    try:
+        commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'pandas': pd.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--events', type=int, nargs='+', default=[10000, 100000],
+                        help='approximate number of transcript events of every run')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None, help='json file to write, printed to stdout if not given')
+    args = parser.parse_args(argv)
+
+    results = {'environment': environment(), 'runs': []}
+    for n_events in args.events:
+        results['runs'].append(run_scale(n_events, seed=args.seed))
+        for name, stage in results['runs'][-1]['stages'].items():
+            print('{:>10} events {:>18}: {:8.3f} s {:10.1f} MB'.format(n_events, name, stage['seconds'],
+                                                                      stage['peak_bytes'] / 1e6), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
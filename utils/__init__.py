@@ -0,0 +1,14 @@
+"""
+Helper modules of the notebooks. Submodules are imported on first attribute access, e.g. utils.plots, so importing
+the package does not import them.
+"""
+import importlib
+
+
+def __getattr__(name):
+    try:
+        return importlib.import_module('{}.{}'.format(__name__, name))
+    except ModuleNotFoundError as error:
+        if error.name != '{}.{}'.format(__name__, name):
+            raise
+        raise AttributeError("module '{}' has no attribute '{}'".format(__name__, name)) from None
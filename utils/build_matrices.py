@@ -1,219 +1,294 @@
+import logging
+from collections import namedtuple
+
 import numpy as np
-import pandas as pd
 
+from utils.instrumentation import annotate, instrumented
+from utils.intervals import group_coverage, in_group_intervals, search_group_times
+from utils.lazy import lazy_import
+from utils.schema import OFFER_SCHEMA, PROFILE_EXPANDED_SCHEMA, apply_schema
 
-def build_user_df(portfolio, profile, transcript, offers):
-    users = np.array(profile['id'])
+pd = lazy_import('pandas')
+logger = logging.getLogger(__name__)
+
+# Offer attributes as NumPy arrays aligned with the offer ids in index. Offer types are categorical codes into
+# types, durations are in hours.
+OfferTable = namedtuple('OfferTable', ['index', 'type_codes', 'types', 'difficulty', 'reward', 'duration'])
 
-    user_dict = {}
-    max_time = transcript.loc[:, 'time'].max()
-
-    for user in users:
-        user_transcript = transcript.loc[transcript['id'] == user, :]
-
-        user_transactions = user_transcript.loc[user_transcript['event'] == 'transaction', ['time', 'amount']]
-        user_offers = offers[offers['user_id'] == user]
-
-        total_spent = user_transactions['amount'].sum()
-        # It would be tempting to do: total_spent_in_window = user_offers['amount_in_window'].sum()
-        # that is not possible since we have overlapping offers, that counts the spending twice.
-        # Instead we have to mask any transaction in the union of time windows
-        spent_in_window = 0
-        spent_in_discount_window = 0
-        spent_in_bogo_window = 0
-        spent_in_info_window = 0
-        spent_no_window = 0
-        for i, row in user_transactions.iterrows():
-            # the below test is based on the fact that comparing a value with nan returns false, thus if not viewed, automatically it will be nan
-            # the test checks if the transaction time is inside any of the "valid windows" of all offers given to the user.
-            transaction_in_window = np.any((user_offers['view_time'] <= row['time']) &
-                                           (user_offers['view_time'] + user_offers['time_in_window'] >= row['time']))
-            if transaction_in_window:
-                spent_in_window += row['amount']
-            else:
-                spent_no_window += row['amount']
-
-        assert np.isclose(spent_in_window + spent_no_window, total_spent, rtol=1e-5,
-                          atol=1e-3), 'summation of spendings not correct'
-
-        # Get amount spent in specific windows. Here, double booking is allowed to happen
-        spent_in_discount_window = user_offers.loc[user_offers['offer_type'] == 'discount', 'amount_in_window'].sum()
-        spent_in_bogo_window = user_offers.loc[user_offers['offer_type'] == 'bogo', 'amount_in_window'].sum()
-        spent_in_info_window = user_offers.loc[user_offers['offer_type'] == 'informational', 'amount_in_window'].sum()
-
-        # Get time spent in any window
-        windows = list(zip(user_offers['view_time'], user_offers['view_time'] + user_offers['time_in_window']))
-        intervals = merged_intervals(windows)
-        time_in_windows = np.diff(np.array(intervals).transpose(), axis=0).sum()
-        time_no_windows = max_time - time_in_windows
-
-        windows_discount = list(zip(user_offers.loc[user_offers['offer_type'] == 'discount', 'view_time'],
-                                    user_offers.loc[user_offers['offer_type'] == 'discount', 'view_time'] +
-                                    user_offers.loc[user_offers['offer_type'] == 'discount', 'time_in_window']))
-        intervals_discount = merged_intervals(windows_discount)
-        windows_bogo = list(zip(user_offers.loc[user_offers['offer_type'] == 'bogo', 'view_time'],
-                                user_offers.loc[user_offers['offer_type'] == 'bogo', 'view_time'] +
-                                user_offers.loc[user_offers['offer_type'] == 'bogo', 'time_in_window']))
-        intervals_bogo = merged_intervals(windows_bogo)
-        windows_info = list(zip(user_offers.loc[user_offers['offer_type'] == 'informational', 'view_time'],
-                                user_offers.loc[user_offers['offer_type'] == 'informational', 'view_time'] +
-                                user_offers.loc[user_offers['offer_type'] == 'informational', 'time_in_window']))
-        intervals_info = merged_intervals(windows_info)
-        time_in_discount = np.diff(np.array(intervals_discount).transpose(), axis=0).sum()
-        if np.isnan(time_in_discount):
-            time_in_discount = 0
-        time_in_bogo = np.diff(np.array(intervals_bogo).transpose(), axis=0).sum()
-        if np.isnan(time_in_bogo):
-            time_in_bogo = 0
-        time_in_info = np.diff(np.array(intervals_info).transpose(), axis=0).sum()
-        if np.isnan(time_in_info):
-            time_in_info = 0
-
-        if user_offers.shape[0] == 0:
-            print("user {} has no offers to extract data from".format(user))
-            view_ratio = 0
-            completion_ratio = 0
-            view_and_complete_ratio = 0
-        else:
-            view_ratio = user_offers['viewed'].sum() / user_offers.shape[0]
-            completion_ratio = user_offers['completed'].sum() / user_offers.shape[0]
-            view_and_complete_ratio = user_offers.loc[(user_offers['completed'] == 1) & (
-                        user_offers['viewed'] == 1), 'start_time'].count() / user_offers.shape[0]
-
-        user_dict.update({user: {'spent_total': total_spent,
-                                 'spent_in_window': spent_in_window,
-                                 'spent_no_window': spent_no_window,
-                                 'spent_in_discount': spent_in_discount_window,
-                                 'spent_in_bogo': spent_in_bogo_window,
-                                 'spent_in_informational': spent_in_info_window,
-                                 'time_in_window': float(time_in_windows) + 1,
-                                 # add one to avoid infinity for users that view, spend and complete in the same hour
-                                 'time_no_window': time_no_windows + 1,
-                                 'time_in_discount': time_in_discount + 1,
-                                 'time_in_bogo': time_in_bogo + 1,
-                                 'time_in_informational': time_in_info + 1,
-                                 'view_ratio': view_ratio,
-                                 'completion_ratio': completion_ratio,
-                                 'view_and_complete_ratio': view_and_complete_ratio,
-                                 'num_offers_received': user_offers.shape[0]}})
-
-    expanded = pd.DataFrame.from_dict(user_dict, orient='index').reset_index().rename(columns={'index': 'user_id'})
+
+@instrumented('build_user_df', rows_arg=2)
+def build_user_df(portfolio, profile, transcript, offers, max_time=None):
+    """
+    Builds the expanded profile with one row per user of spendings, time in offer windows and offer ratios, in the
+    types of utils.schema.PROFILE_EXPANDED_SCHEMA.
+    The offer windows of all users are merged at once by the interval kernel in utils.intervals.
+    :param max_time: last hour of the experiment, defaults to the time of the last event in transcript
+    """
+    users = np.array(profile['id'])
+    if max_time is None:
+        max_time = transcript.loc[:, 'time'].max()
+    user_transcripts, offsets = group_transcript_by_user(transcript, users)
+    event_users = np.repeat(np.arange(len(users)), np.diff(offsets))
+
+    is_transaction = np.asarray(user_transcripts['event']) == 'transaction'
+    transaction_users = event_users[is_transaction]
+    transaction_times = np.asarray(user_transcripts['time'])[is_transaction]
+    transaction_amounts = np.asarray(user_transcripts['amount'])[is_transaction]
+    transaction_offsets = np.searchsorted(transaction_users, np.arange(len(users) + 1))
+    total_spent = _window_sums(transaction_amounts, transaction_offsets[:-1], transaction_offsets[1:])
+
+    offer_users = pd.Categorical(offers['user_id'], categories=users).codes
+    known = offer_users >= 0
+    order = np.argsort(offer_users[known], kind='stable')
+    offer_users = offer_users[known][order]
+    offer_types = np.asarray(offers['offer_type'])[known][order]
+    window_start = offers['view_time'].to_numpy(dtype=float, na_value=np.nan)[known][order]
+    window_end = window_start + np.asarray(offers['time_in_window'])[known][order]
+    amount_in_window = np.asarray(offers['amount_in_window'], dtype=float)[known][order]
+    viewed = np.asarray(offers['viewed'])[known][order]
+    completed = np.asarray(offers['completed'])[known][order]
+
+    # It would be tempting to do: total_spent_in_window = user_offers['amount_in_window'].sum()
+    # that is not possible since we have overlapping offers, that counts the spending twice.
+    # Instead we have to mask any transaction in the union of time windows
+    # the windows of offers that were not viewed have a nan start and are ignored.
+    transaction_in_window = in_group_intervals(offer_users, window_start, window_end,
+                                               transaction_users, transaction_times)
+    spent_in_window = np.bincount(transaction_users[transaction_in_window],
+                                  weights=transaction_amounts[transaction_in_window], minlength=len(users))
+    spent_no_window = np.bincount(transaction_users[~transaction_in_window],
+                                  weights=transaction_amounts[~transaction_in_window], minlength=len(users))
+
+    assert np.allclose(spent_in_window + spent_no_window, total_spent, rtol=1e-5,
+                       atol=1e-3), 'summation of spendings not correct'
+
+    # Get time spent in any window
+    time_in_windows = group_coverage(offer_users, window_start, window_end, len(users))
+    time_no_windows = max_time - time_in_windows
+
+    # Get amount and time spent in specific windows. Here, double booking is allowed to happen for the amounts
+    spent_in_type_window = {}
+    time_in_type_window = {}
+    for kind in ['discount', 'bogo', 'informational']:
+        is_kind = offer_types == kind
+        kind_offsets = np.searchsorted(offer_users[is_kind], np.arange(len(users) + 1))
+        spent_in_type_window[kind] = _window_sums(amount_in_window[is_kind], kind_offsets[:-1], kind_offsets[1:])
+        time_in_type_window[kind] = group_coverage(offer_users[is_kind], window_start[is_kind], window_end[is_kind],
+                                                   len(users))
+
+    num_offers = np.bincount(offer_users, minlength=len(users))
+    has_offers = num_offers > 0
+    if not has_offers.all():
+        logger.info("%d users have no offers to extract data from", (~has_offers).sum())
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("users without offers: %s", ', '.join(map(str, users[~has_offers])))
+    annotate(users_without_offers=int((~has_offers).sum()))
+    view_ratio = np.zeros(len(users))
+    completion_ratio = np.zeros(len(users))
+    view_and_complete_ratio = np.zeros(len(users))
+    view_ratio[has_offers] = np.bincount(offer_users, weights=viewed, minlength=len(users))[has_offers] / \
+        num_offers[has_offers]
+    completion_ratio[has_offers] = np.bincount(offer_users, weights=completed, minlength=len(users))[has_offers] / \
+        num_offers[has_offers]
+    view_and_complete_ratio[has_offers] = np.bincount(offer_users[(viewed == 1) & (completed == 1)],
+                                                      minlength=len(users))[has_offers] / num_offers[has_offers]
+
+    expanded = pd.DataFrame({'user_id': users,
+                             'spent_total': total_spent,
+                             'spent_in_window': spent_in_window,
+                             'spent_no_window': spent_no_window,
+                             'spent_in_discount': spent_in_type_window['discount'],
+                             'spent_in_bogo': spent_in_type_window['bogo'],
+                             'spent_in_informational': spent_in_type_window['informational'],
+                             'time_in_window': time_in_windows + 1,
+                             # add one to avoid infinity for users that view, spend and complete in the same hour
+                             'time_no_window': time_no_windows + 1,
+                             'time_in_discount': time_in_type_window['discount'] + 1,
+                             'time_in_bogo': time_in_type_window['bogo'] + 1,
+                             'time_in_informational': time_in_type_window['informational'] + 1,
+                             'view_ratio': view_ratio,
+                             'completion_ratio': completion_ratio,
+                             'view_and_complete_ratio': view_and_complete_ratio,
+                             'num_offers_received': num_offers})
 
     profile_expanded = pd.merge(profile.sort_values('id'), expanded.sort_values('user_id'), left_on='id',
                                 right_on='user_id').drop(columns='id')
-    return profile_expanded
+    return apply_schema(profile_expanded, PROFILE_EXPANDED_SCHEMA)
 
 
+@instrumented('build_offer_df', rows_arg=2)
 def build_offer_df(portfolio, profile, transcript):
-    # iterate over users
+    """
+    Builds the offer matrix with one row per offer received by a user.
+    The transcript is grouped by user once, each user's events are then found by offsets instead of scanning the
+    full transcript for every user.
+    """
+    offer_df, count_users_no_offer = build_offer_rows(portfolio, profile, transcript)
+    offer_df = add_offer_type_dummies(offer_df)
+    logger.info("%d received no offer", count_users_no_offer)
+    annotate(users_no_offer=count_users_no_offer)
+    return offer_df
+
+
+def build_offer_rows(portfolio, profile, transcript):
+    """
+    Builds the offer matrix without the offer type dummies, in the types of utils.schema.OFFER_SCHEMA
+    :return: (offer matrix, number of users that received no offer)
+    """
     users = profile['id'].unique()
+    user_transcripts, offsets = group_transcript_by_user(transcript, users)
+    events = np.asarray(user_transcripts['event'])
+    times = np.asarray(user_transcripts['time'])
+    event_offer_ids = np.asarray(user_transcripts['offer_id'])
+    amounts = np.asarray(user_transcripts['amount'])
+
+    # received offers are already ordered by user and then by transcript order
+    event_users = np.repeat(np.arange(len(users)), np.diff(offsets))
+    received = np.flatnonzero(events == 'offer received')
+    received_user = event_users[received]
+    count_users_no_offer = len(users) - len(np.unique(received_user))
+
+    offer_ids = event_offer_ids[received]
+    offers_start = times[received]
+
+    # resolve the offer attributes of all received offers with one gather each
+    offer_table = build_offer_table(portfolio)
+    offer_codes = lookup_offer_codes(offer_table, offer_ids)
+    offers_duration = offer_table.duration[offer_codes]
+    offers_difficulty = offer_table.difficulty[offer_codes]
+    offers_reward = offer_table.reward[offer_codes]
+    offers_type = offer_table.types[offer_table.type_codes[offer_codes]]
+    offers_end = offers_start + offers_duration
+
+    # every (user, offer id) pair is one group, views and completions are matched to received offers per group
+    event_groups = _offer_groups(event_users, event_offer_ids)
+    received_groups = event_groups[received]
+    is_view = events == 'offer viewed'
+    is_completion = events == 'offer completed'
+
+    # identify the first completion event within the offer
+    completion = match_offer_events(received_groups, offers_start, offers_end,
+                                    event_groups[is_completion], times[is_completion])
+    complet_time = np.append(times[is_completion], np.nan)[completion]
+    completed = (completion >= 0).astype(int)
+
+    # identify the first view event within the offer, views after completion will be regarded as not viewed.
+    # A completion in hour 0 has never cut off the views or the window, this is kept to produce the same matrix.
+    cutoff = np.where(completed & (complet_time != 0), complet_time, np.nan)
+    view = match_offer_events(received_groups, offers_start, np.fmin(offers_end, cutoff),
+                              event_groups[is_view], times[is_view])
+    view_time = np.append(times[is_view], np.nan)[view]
+    viewed = (view >= 0).astype(int)
+
+    # time from viewed to completion or end of offer window.
+    window_end = np.where(np.isnan(cutoff), offers_end, cutoff)
+    time_in_window = np.where(viewed, window_end - view_time + 1, 0).astype(int)
+
+    # cumulative amount spent in valid window, if no valid window, no amount spent due to offer
+    is_transaction = events == 'transaction'
+    transaction_users = event_users[is_transaction]
+    transaction_times = times[is_transaction]
+    was_viewed = viewed.astype(bool)
+    window_user = received_user[was_viewed]
+    window_start = view_time[was_viewed].astype(np.int64)
+    window_stop = window_start + time_in_window[was_viewed]
+    amount_in_window = np.zeros(len(received))
+    amount_in_window[was_viewed] = _window_sums(
+        amounts[is_transaction],
+        search_group_times(transaction_users, transaction_times, window_user, window_start, side='left'),
+        search_group_times(transaction_users, transaction_times, window_user, window_stop, side='right'))
+
+    offer_df = pd.DataFrame({'offer_id': offer_ids,
+                             'user_id': users[received_user],
+                             'offer_type': offers_type,
+                             'difficulty': offers_difficulty,
+                             'reward': offers_reward,
+                             'start_time': offers_start,
+                             'duration': offers_duration,
+                             'end_time': offers_end,
+                             'viewed': viewed,
+                             'view_time': view_time,
+                             'completed': completed,
+                             'complet_time': complet_time,
+                             'time_in_window': time_in_window,
+                             'amount_in_window': amount_in_window},
+                            index=pd.Index(np.arange(len(received))))
+    return apply_schema(offer_df, OFFER_SCHEMA), count_users_no_offer
+
+
+def add_offer_type_dummies(offer_df):
+    """
+    Adds the type_* dummy columns of the offer types
+    """
+    offer_type_dummies = pd.get_dummies(offer_df.loc[:, 'offer_type'], prefix='type', dtype=bool)
+    return offer_df.merge(offer_type_dummies, left_index=True, right_index=True)
 
-    offers = {}
-    count = 0
-    count_users_no_offer = 0
-    for user in users:
-        # transcripts for specific user
-        user_transcript = transcript.loc[transcript['id'] == user, :]
-        user_transactions = user_transcript.loc[user_transcript['event'] == 'transaction', ['time', 'amount']]
-        offer_ids_tuples = get_user_offer_ids(user_transcript)
-        if len(offer_ids_tuples) < 1:  # if there are no offers given to user, skip the rest.
-            count_users_no_offer += 1
-            continue
-        offer_ids = list(list(zip(*offer_ids_tuples))[1])
-
-        offers_start = get_user_offer_starts(user_transcript)
-        offers_duration = get_user_offer_durations(portfolio, offer_ids)
-        offers_difficulty = get_user_offer_difficulties(portfolio, offer_ids)
-        offers_reward = get_user_offer_rewards(portfolio, offer_ids)
-        offers_type = get_user_offer_types(portfolio, offer_ids)
-        offers_viewed = get_user_offer_views(user_transcript)
-        offers_completed = get_user_offer_completions(user_transcript)
-
-        offers_end = offers_start + offers_duration
-
-        # Test if results are as expected
-        assert len(offer_ids) == len(
-            offers_start), "The number of offerings ({}) are not the same as the number of starting points ({})".format(
-            len(offer_ids), len(offers_start))
-        assert len(offer_ids) == len(
-            offers_type), "The number of offerings ({}) are not the same as the number of offer types ({})".format(
-            len(offer_ids), len(offers_type))
-        assert len(offer_ids) == len(
-            offers_difficulty), "The number of offerings ({}) are not the same as the number of offer difficulties ({})".format(
-            len(offer_ids), len(offers_difficulty))
-        assert len(offer_ids) == len(
-            offers_reward), "The number of offerings ({}) are not the same as the number of offer rewards ({})".format(
-            len(offer_ids), len(offers_reward))
-        assert len(offer_ids) == len(
-            offers_duration), "The number of offerings ({}) are not the same as the number of offer durations ({})".format(
-            len(offer_ids), len(offers_duration))
-
-        # iterate over offers and build dict to be used to fill a dataframe
-        for i, offer_id in offer_ids_tuples:
-            start = offers_start[i]
-            duration = offers_duration[i]
-            end = offers_end[i]
-            kind = offers_type[i]
-            reward = offers_reward[i]
-            difficulty = offers_difficulty[i]
-
-            # identify completion event within the offer
-            completed_time = None
-            completed = 0  # 0 if no completion even, 1 if completion even
-            for time, completion_offer_id in offers_completed:
-                if completion_offer_id == offer_id and time >= start and time <= end:
-                    completed_time = time
-                    completed = 1
-                    break
-
-            # identify view event within the offer, views after completion will be regarded as not viewed
-            viewed_time = None
-            viewed = 0  # 0 if no completion even, 1 if completion even
-            for time, viewed_offer_id in offers_viewed:
-                if completed_time:
-                    if time > completed_time:  # do not accept if time of viewing is after time of completion
-                        break
-                if viewed_offer_id == offer_id and time >= start and time <= end:
-                    viewed_time = time
-                    viewed = 1
-                    break
-
-                    # calculate valid window related parameters
-            time_in_window = 0
-            amount_in_window = 0
-            if viewed:
-                # time from viewed to completion or end of offer window.
-                if completed_time:
-                    time_in_window = completed_time - viewed_time + 1
-                else:
-                    time_in_window = end - viewed_time + 1
-                    # cumulative amount spent in valid window, if no valid window, no amount spent due to offer
-                transactions_in_window = user_transactions.loc[(user_transactions['time'] >= viewed_time) &
-                                                               (user_transactions[
-                                                                    'time'] <= viewed_time + time_in_window), :]
-
-                amount_in_window = transactions_in_window['amount'].sum()
-
-            offers.update({count: {'offer_id': offer_id,
-                                   'user_id': user,
-                                   'offer_type': kind,
-                                   'difficulty': difficulty,
-                                   'reward': reward,
-                                   'start_time': start,
-                                   'duration': duration,
-                                   'end_time': end,
-                                   'viewed': viewed,
-                                   'view_time': viewed_time,
-                                   'completed': completed,
-                                   'complet_time': completed_time,
-                                   'time_in_window': time_in_window,
-                                   'amount_in_window': amount_in_window}})
-            count += 1
-    offer_df = pd.DataFrame.from_dict(offers, orient='index')
-    offer_type_dummies = pd.get_dummies(offer_df.loc[:, 'offer_type'], prefix='type')
-    offer_df = offer_df.merge(offer_type_dummies, left_index=True, right_index=True)
-    print("{} received no offer".format(count_users_no_offer))
-    return offer_df
+
+def add_gender_dummies(profile_expanded):
+    """
+    Adds the gender_* dummy columns, including gender_nan for users without a gender
+    """
+    gender_dummies = pd.get_dummies(profile_expanded.loc[:, 'gender'], prefix='gender', dummy_na=True,
+                                    dtype=bool)
+    return profile_expanded.merge(gender_dummies, left_index=True, right_index=True)
+
+
+def group_transcript_by_user(transcript, users, column='id'):
+    """
+    Sorts the transcript once so that the events of every user form one contiguous slice.
+    The events of users[k] are found in the rows offsets[k]:offsets[k + 1] of the returned transcript. Events of
+    users not in users are dropped, the transcript order is kept within each user.
+    :param transcript: cleaned transcript dataframe, or any dataframe with a user id column such as offer_df
+    :param users: array of unique user ids
+    :param column: name of the user id column
+    :return: (sorted transcript, offsets)
+    """
+    codes = pd.Categorical(transcript[column], categories=users).codes
+    order = np.argsort(codes, kind='stable')
+    sorted_codes = codes[order]
+    order = order[sorted_codes >= 0]
+    offsets = np.searchsorted(sorted_codes, np.arange(len(users) + 1)) - np.count_nonzero(sorted_codes < 0)
+    return transcript.iloc[order], offsets
+
+
+def match_offer_events(offer_groups, offers_start, offers_limit, event_groups, event_times):
+    """
+    Matches every offer to the first event of its group (user and offer id) inside [start, limit].
+    All offers are matched at once by a sorted search over (group, time), so the first event wins like it does
+    when scanning a chronological transcript.
+    :param offer_groups: group of every offer
+    :param offers_start: start time of every offer
+    :param offers_limit: last time an event is accepted for every offer
+    :param event_groups: group of every event
+    :param event_times: time of every event
+    :return: array with the index of the matched event for every offer, -1 if no event matched
+    """
+    if len(event_groups) == 0:
+        return np.full(len(offer_groups), -1)
+    order = np.lexsort((event_times, event_groups))
+    sorted_groups = event_groups[order]
+    sorted_times = event_times[order]
+    first = search_group_times(sorted_groups, sorted_times, offer_groups, offers_start, side='left')
+    candidate = np.minimum(first, len(order) - 1)
+    matched = (first < len(order)) & (sorted_groups[candidate] == offer_groups) & \
+              (sorted_times[candidate] <= offers_limit)
+    return np.where(matched, order[candidate], -1)
+
+
+def _offer_groups(user_codes, offer_ids):
+    """
+    Returns an integer group per event for the (user, offer id) pair, -1 for events without an offer id
+    """
+    offer_codes, uniques = pd.factorize(offer_ids)
+    return np.where(offer_codes >= 0, user_codes.astype(np.int64) * len(uniques) + offer_codes, -1)
+
+
+def _window_sums(values, starts, stops):
+    """
+    Sums values[start:stop] for every window.
+    Each window is summed by NumPy, as pandas does, so the sums are identical to Series.sum() on the same rows.
+    """
+    return np.array([values[start:stop].sum() for start, stop in zip(starts, stops)], dtype=float)
 
 
 def get_user_offer_ids(user_transcript):
@@ -233,40 +308,74 @@ def get_user_offer_starts(user_transcript):
     return offers_start
 
 
+def build_offer_table(portfolio):
+    """
+    Precomputes the attributes of every offer in the portfolio, to be looked up by offer id
+    :param portfolio: cleaned portfolio dataframe
+    :return: OfferTable
+    """
+    offer_types = pd.Categorical(portfolio['offer_type'])
+    return OfferTable(index=pd.Index(portfolio['id']),
+                      type_codes=np.asarray(offer_types.codes),
+                      types=np.asarray(offer_types.categories, dtype=str),
+                      difficulty=np.asarray(portfolio['difficulty']).astype(int),
+                      reward=np.asarray(portfolio['reward']).astype(int),
+                      duration=np.asarray(portfolio['duration']).astype(int) * 24)
+
+
+def lookup_offer_codes(offer_table, offer_ids):
+    """
+    Returns the position of every offer id in the offer table
+    """
+    codes = offer_table.index.get_indexer(np.asarray(offer_ids))
+    if np.any(codes < 0):
+        raise KeyError("offer ids not in portfolio: {}".format(np.unique(np.asarray(offer_ids)[codes < 0])))
+    return codes
+
+
+def as_offer_table(portfolio):
+    """
+    Returns portfolio as an OfferTable, building the table if a portfolio dataframe is given
+    """
+    if isinstance(portfolio, OfferTable):
+        return portfolio
+    return build_offer_table(portfolio)
+
+
 def get_user_offer_types(portfolio, offer_ids):
     """
     Extracts offer types of offers presented to the user
+    :param portfolio: cleaned portfolio dataframe or OfferTable
     """
-    offers_type = np.array(
-        [portfolio.loc[portfolio['id'] == offer_id, 'offer_type'].values.astype(str)[0] for offer_id in offer_ids])
-    return offers_type
+    offer_table = as_offer_table(portfolio)
+    return offer_table.types[offer_table.type_codes[lookup_offer_codes(offer_table, offer_ids)]]
 
 
 def get_user_offer_difficulties(portfolio, offer_ids):
     """
     Extracts difficulty of offers presented to the user
+    :param portfolio: cleaned portfolio dataframe or OfferTable
     """
-    offers_difficulty = np.array(
-        [portfolio.loc[portfolio['id'] == offer_id, 'difficulty'].values.astype(str)[0] for offer_id in offer_ids])
-    return offers_difficulty
+    offer_table = as_offer_table(portfolio)
+    return offer_table.difficulty[lookup_offer_codes(offer_table, offer_ids)]
 
 
 def get_user_offer_rewards(portfolio, offer_ids):
     """
-    Extracts difficulty of offers presented to the user
+    Extracts reward of offers presented to the user
+    :param portfolio: cleaned portfolio dataframe or OfferTable
     """
-    offers_reward = np.array(
-        [portfolio.loc[portfolio['id'] == offer_id, 'reward'].values.astype(str)[0] for offer_id in offer_ids])
-    return offers_reward
+    offer_table = as_offer_table(portfolio)
+    return offer_table.reward[lookup_offer_codes(offer_table, offer_ids)]
 
 
 def get_user_offer_durations(portfolio, offer_ids):
     """
-    Extracts difficulty of offers presented to the user
+    Extracts duration in hours of offers presented to the user
+    :param portfolio: cleaned portfolio dataframe or OfferTable
     """
-    offers_duration = np.array(
-        [portfolio.loc[portfolio['id'] == offer_id, 'duration'].values.astype(int)[0] * 24 for offer_id in offer_ids])
-    return offers_duration
+    offer_table = as_offer_table(portfolio)
+    return offer_table.duration[lookup_offer_codes(offer_table, offer_ids)]
 
 
 def get_user_offer_views(user_transcript):
@@ -292,19 +401,15 @@ def merged_intervals(windows):
     Expect a list of list of the form [[starttime, endtime], [starttime, endtime],...]
     Sorts by start time and returns a list of list ordered
     """
+    # drop windows with nan before sorting, nan keys would leave the remaining windows unsorted
+    windows = [[s, e] for s, e in windows if not (np.isnan(s) or np.isnan(e))]
     if len(windows) == 0:
         return [[0], [0]]
-    if np.all([np.isnan(s) for s, e in windows]):
-        return [[0], [0]]
     windows.sort(key=lambda x: x[0])
-    while np.isnan(windows[0][0]):
-        windows.pop(0)
     intervals = [[windows[0][0], windows[0][1]]]
     if len(windows) == 1:
         return intervals
     for start, end in windows[1:]:
-        if np.isnan(start) or np.isnan(end):
-            continue
         if start < intervals[-1][1]:
             if end > intervals[-1][
                 1]:  # if start of next window is less than current interval, then change interval end
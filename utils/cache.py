@@ -0,0 +1,219 @@
+import ast
+import hashlib
+import os
+import re
+import shutil
+
+from utils.build_matrices import add_gender_dummies, build_offer_df, build_user_df
+from utils.cleaning import clean_data
+from utils.cube import Cube, build_cube
+from utils.incremental import update_matrices, user_fingerprints
+from utils.loading import load_all
+from utils.schema import OFFER_DUMMIES, OFFER_SCHEMA, PROFILE_EXPANDED_DUMMIES, PROFILE_EXPANDED_SCHEMA, validate
+
+# bump when the tables change in a way the source hash does not capture, e.g. a new pandas/pyarrow behaviour
+CACHE_VERSION = 1
+INPUT_FILES = ['portfolio.json', 'profile.json', 'transcript.json']
+TABLES = ['portfolio', 'profile', 'transcript', 'offer_df', 'profile_expanded', 'cube', 'cube_bins']
+# (schema, dummy prefix) the matrices are validated against when read
+SCHEMAS = {'offer_df': (OFFER_SCHEMA, OFFER_DUMMIES),
+           'profile_expanded': (PROFILE_EXPANDED_SCHEMA, PROFILE_EXPANDED_DUMMIES)}
+# content hashes of files by (path, size, modification time)
+_file_hashes = {}
+# names of the directories of cache keys, other directories in the cache directory are kept
+KEY_PATTERN = re.compile(r'^[0-9a-f]{16}(-[0-9a-f]{16})+$')
+
+
+def cache_key(data_dir='data'):
+    """
+    Returns the cache key '<code hash>-<portfolio hash>-<profile hash>-<transcript hash>'.
+    The code hash covers the source of this module and of every utils module it imports, directly or indirectly, so
+    editing any of them invalidates the cached tables. The other hashes cover the content of each input json file,
+    so a previous build can tell which inputs changed.
+    :param data_dir: directory of the input json files
+    :return: str
+    """
+    code_paths = [os.path.join(os.path.dirname(os.path.abspath(__file__)), name) for name in source_modules('cache.py')]
+    return '-'.join([_hash_files(code_paths, str(CACHE_VERSION))] +
+                    [_hash_files([os.path.join(data_dir, name)]) for name in INPUT_FILES])
+
+
+def _hash_files(paths, salt=''):
+    """
+    Returns a short sha256 hex digest of the names and content of the files
+    """
+    digest = hashlib.sha256(salt.encode())
+    for path in paths:
+        digest.update(os.path.basename(path).encode())
+        digest.update(hash_file(path).encode())
+    return digest.hexdigest()[:16]
+
+
+def hash_file(path):
+    """
+    Returns the sha256 hex digest of the content of a file, rehashed only when its size or modification time change
+    """
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    if key not in _file_hashes:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1 << 20), b''):
+                digest.update(block)
+        _file_hashes[key] = digest.hexdigest()
+    return _file_hashes[key]
+
+
+def source_modules(*modules):
+    """
+    Returns the file names of the utils modules and of all utils modules they import, directly or indirectly,
+    e.g. source_modules('cleaning.py') for utils/cleaning.py. Imports are read from the source, also those inside
+    functions.
+    :return: sorted list of file names in utils/
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    found = set()
+    pending = list(modules)
+    while pending:
+        module = pending.pop()
+        if module in found or not os.path.exists(os.path.join(directory, module)):
+            continue
+        found.add(module)
+        with open(os.path.join(directory, module)) as f:
+            tree = ast.parse(f.read())
+        for node in ast.walk(tree):
+            if isinstance(node, ast.ImportFrom) and node.module == 'utils':
+                names = [alias.name for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and node.module.startswith('utils.'):
+                names = [node.module]
+            elif isinstance(node, ast.Import):
+                names = [alias.name for alias in node.names if alias.name.startswith('utils.')]
+            else:
+                continue
+            pending.extend(name.split('.')[-1] + '.py' for name in names)
+    return sorted(found)
+
+
+def build_tables(data_dir='data'):
+    """
+    Loads and cleans the input data and builds the matrices
+    :return: dict of table name to dataframe
+    """
+    portfolio, profile, transcript = clean_data(*load_all(data_dir))
+    offer_df = build_offer_df(portfolio, profile, transcript)
+    profile_expanded = add_gender_dummies(build_user_df(portfolio, profile, transcript, offer_df))
+    return dict(cube_tables(portfolio, offer_df, profile_expanded),
+                portfolio=portfolio, profile=profile, transcript=transcript, offer_df=offer_df,
+                profile_expanded=profile_expanded, user_fingerprints=user_fingerprints(transcript))
+
+
+def update_tables(previous_directory, data_dir='data'):
+    """
+    Loads and cleans the input data and updates the matrices cached in previous_directory, rebuilding only the users
+    with new or changed events or a changed profile row. The previous build must be of the same portfolio.
+    See utils.incremental.update_matrices.
+    :return: dict of table name to dataframe
+    """
+    portfolio, profile, transcript = clean_data(*load_all(data_dir))
+    previous = {name: read_table(os.path.join(previous_directory, name + '.feather'))
+                for name in ['profile', 'offer_df', 'profile_expanded', 'user_fingerprints']}
+    offer_df, profile_expanded, fingerprints = update_matrices(portfolio, profile, transcript, previous['offer_df'],
+                                                               previous['profile_expanded'],
+                                                               previous['user_fingerprints'],
+                                                               previous_profile=previous['profile'])
+    return dict(cube_tables(portfolio, offer_df, profile_expanded),
+                portfolio=portfolio, profile=profile, transcript=transcript, offer_df=offer_df,
+                profile_expanded=profile_expanded, user_fingerprints=fingerprints)
+
+
+def cube_tables(portfolio, offer_df, profile_expanded):
+    """
+    Builds the aggregate cube of utils.cube as the tables cube and cube_bins
+    """
+    cube = build_cube(portfolio, offer_df, profile_expanded)
+    return {'cube': cube.cells, 'cube_bins': cube.bin_edges.rename_axis('metric').reset_index()}
+
+
+def load_cached(name, columns=None, data_dir='data', cache_dir='cache'):
+    """
+    Returns a cleaned table or a built matrix from the columnar cache.
+    The cache is keyed by cache_key() and the stale tables are removed when a new key is built. When the transcript or
+    the profile have changed since the last build, the matrices are updated incrementally for the users with new
+    events or a changed profile row, when the code or the portfolio have changed all tables are rebuilt. The matrices
+    are validated against utils.schema.
+    :param name: one of TABLES
+    :param columns: list of columns to read, all columns if None
+    :param data_dir: directory of the input json files
+    :param cache_dir: directory of the cache
+    :return: pd.DataFrame
+    """
+    if name not in TABLES:
+        raise ValueError("unknown table {}, expected one of {}".format(name, TABLES))
+    key = cache_key(data_dir)
+    directory = os.path.join(cache_dir, key)
+    if not os.path.exists(os.path.join(directory, name + '.feather')):
+        code_key, portfolio_key = key.split('-')[:2]
+        previous = _previous_build(cache_dir, code_key, portfolio_key)
+        tables = update_tables(previous, data_dir) if previous else build_tables(data_dir)
+        write_tables(tables, directory)
+        remove_stale(cache_dir, keep=os.path.basename(directory))
+    table = read_table(os.path.join(directory, name + '.feather'), columns=columns)
+    if name in SCHEMAS:
+        schema, dummies = SCHEMAS[name]
+        validate(table, schema, dummies, partial=columns is not None)
+    return table
+
+
+def load_cube(data_dir='data', cache_dir='cache'):
+    """
+    Returns the aggregate cube of utils.cube from the cache
+    """
+    return Cube(load_cached('cube', data_dir=data_dir, cache_dir=cache_dir),
+                load_cached('cube_bins', data_dir=data_dir, cache_dir=cache_dir).set_index('metric'))
+
+
+def write_tables(tables, directory):
+    """
+    Writes every table as an uncompressed feather file, which can be memory-mapped on read.
+    Files are written under a temporary name and renamed, so a cache directory never holds a partial table.
+    """
+    from pyarrow import feather
+
+    os.makedirs(directory, exist_ok=True)
+    for name, table in tables.items():
+        path = os.path.join(directory, name + '.feather')
+        feather.write_feather(table, path + '.tmp', compression='uncompressed')
+        os.replace(path + '.tmp', path)
+
+
+def read_table(path, columns=None):
+    """
+    Reads the given columns of a feather file through a memory map
+    """
+    from pyarrow import feather
+
+    return feather.read_table(path, columns=columns, memory_map=True).to_pandas()
+
+
+def _previous_build(cache_dir, code_key, portfolio_key):
+    """
+    Returns a complete cache directory built by the same code from the same portfolio, None if there is none
+    """
+    if not os.path.isdir(cache_dir):
+        return None
+    for entry in sorted(os.listdir(cache_dir)):
+        directory = os.path.join(cache_dir, entry)
+        complete = all(os.path.exists(os.path.join(directory, name + '.feather'))
+                       for name in TABLES + ['user_fingerprints'])
+        if entry.split('-')[:2] == [code_key, portfolio_key] and complete:
+            return directory
+    return None
+
+
+def remove_stale(cache_dir, keep):
+    """
+    Removes all cache key directories except keep
+    """
+    for entry in os.listdir(cache_dir):
+        if entry != keep and KEY_PATTERN.match(entry) and os.path.isdir(os.path.join(cache_dir, entry)):
+            shutil.rmtree(os.path.join(cache_dir, entry))
@@ -1,6 +1,15 @@
-import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
 
+from utils.instrumentation import annotate, instrumented
+from utils.lazy import lazy_import, resolve
+from utils.segments import add_buckets
+
+pd = lazy_import('pandas')
+
+
+@instrumented('clean_portfolio')
 def clean_portfolio(df):
     """
     Cleans and imputes the portfolio dataframe according to findings in exploratory analysis
@@ -8,7 +17,7 @@ def clean_portfolio(df):
     :param df: raw data portfolio dataframe
     :return: pd.Dataframe
     """
-    df = df.copy(deep=True)
+    df = _copy(df)
     # Get all unique channels
     channels = np.unique([channel for chans in df['channels'].items() for channel in chans[1]])
     # Create dummy values for channels
@@ -20,58 +29,82 @@ def clean_portfolio(df):
     df = pd.concat((df, type_dummies), axis=1, sort=False)
     return df
 
-def clean_profile_data(df):
+@instrumented('clean_profile_data')
+def clean_profile_data(df, buckets=False):
     """
         :type df: pd.DataFrame
+        :param buckets: if True, adds the age_bucket, income_bucket and member_cohort columns of utils.segments
     """
-    df = df.copy(deep=True)
+    df = _copy(df)
     df['became_member_on'] = pd.to_datetime(df['became_member_on'], format="%Y%m%d")
+    if buckets:
+        df = add_buckets(df)
     return df
 
 
+@instrumented('clean_transcript')
 def clean_transcript(df):
     """
     Initial cleaning of transcripts. Does not clean based on findings needing other input. See clean_dataset().
     :type df: pd.DataFrame
     """
+    df = _copy(df)
+    if 'value' not in df.columns:
+        # already split by utils.loading.load_transcript
+        return df
     # Extract data from the value column
-    df = df.copy(deep=True)
-    df['value_keys'] = df['value'].apply(lambda d: list(d.keys()))
-
-    offer_id = df.loc[:, ['value_keys', 'value']].apply(_value_return, axis=1,
-                                                                wanted_key=['offer_id', 'offer id'])
-    amount = df.loc[:, ['value_keys', 'value']].apply(_value_return, axis=1, wanted_key=['amount'])
-    reward = df.loc[:, ['value_keys', 'value']].apply(_value_return, axis=1, wanted_key=['reward'])
+    offer_id, amount, reward = split_values(df['value'])
     df['offer_id'] = offer_id
     df['amount'] = amount
     df['reward'] = reward
     #Remove unwanted columns
-    df = df.drop(columns= ['value', 'value_keys'])
+    df = df.drop(columns= ['value'])
     df = df.rename(columns={'person': 'id'},)
     return df
 
-def clean_data(portfolio, profile, transcript):
+@instrumented('clean_data', rows_arg=2)
+def clean_data(portfolio, profile, transcript, buckets=False, n_workers=1):
     """
     returns clean dataframes which has been cleaned based on cross data investigation from the exploratory analysis
+    The three dataframes are cleaned independently of each other, in a thread pool if n_workers > 1, the raw
+    dataframes are not modified.
     :param portfolio:
     :param profile:
     :param transcript:
+    :param buckets: if True, the profile gets the segment buckets, see clean_profile_data
+    :param n_workers: number of threads, 1 cleans the dataframes one after another without a pool
     :return:
     """
     #perform initial cleaning
-    portfolio_clean = clean_portfolio(portfolio)
-    profile_clean = clean_profile_data(profile)
-    transcript_clean = clean_transcript(transcript)
+    if n_workers > 1:
+        resolve(pd)
+        with ThreadPoolExecutor(max_workers=n_workers) as executor:
+            portfolio_clean = executor.submit(clean_portfolio, portfolio)
+            profile_clean = executor.submit(clean_profile_data, profile, buckets=buckets)
+            transcript_clean = executor.submit(clean_transcript, transcript)
+            portfolio_clean, profile_clean, transcript_clean = (portfolio_clean.result(), profile_clean.result(),
+                                                                transcript_clean.result())
+    else:
+        portfolio_clean = clean_portfolio(portfolio)
+        profile_clean = clean_profile_data(profile, buckets=buckets)
+        transcript_clean = clean_transcript(transcript)
 
     #perform cleaning and imputes which are based on cross data undertanding
-
-    #remove users with default profiles and no transactions
-    non_informing_users = get_non_informing_users(transcript_clean, profile_clean)
-    profile_clean = profile_clean[~profile_clean['id'].isin(non_informing_users)]
-    transcript_clean = transcript_clean[~transcript_clean['id'].isin(non_informing_users)]
+    profile_clean, transcript_clean = remove_non_informing_users(profile_clean, transcript_clean)
 
     return portfolio_clean, profile_clean, transcript_clean
 
+def remove_non_informing_users(profile, transcript):
+    """
+    Removes users with default profiles and no transactions from the cleaned profile and transcript
+    :return: (profile, transcript)
+    """
+    non_informing = non_informing_user_mask(transcript, profile)
+    transcript = transcript[~event_mask(transcript, profile['id'], non_informing)]
+    profile = profile[~non_informing]
+    annotate(users_removed=int(non_informing.sum()))
+    return profile, transcript
+
 def get_users_with_most_transactions(transcript,  n=2):
     """
     Return a list of user ids ranked from most transactions recorded
@@ -79,14 +112,11 @@ def get_users_with_most_transactions(transcript,  n=2):
     :param n:
     :return:
     """
-    idx = pd.IndexSlice
-    grouped_person = transcript.groupby(by=['event','id']).count()
-    ranked_person = grouped_person.loc[idx['transaction',:],:].sort_values(by='amount', ascending=False)
-    ranked_person = ranked_person.reset_index(level=0, drop=True).reset_index()
-    ranked_list = list(ranked_person['id'])
-    if n>len(ranked_list):
-        n = len(ranked_list)
-    return ranked_list[:n]
+    codes, users = pd.factorize(transcript['id'], sort=True)
+    counts = user_transaction_counts(transcript, users)
+    ranked = np.argsort(-counts, kind='stable')
+    ranked = ranked[counts[ranked] > 0]
+    return list(users[ranked[:n]])
 
 def get_users_with_transactions(transcript):
     """
@@ -95,15 +125,8 @@ def get_users_with_transactions(transcript):
     :type transcript: pd.DataFrame
     :return:  list of userids
     """
-    df = transcript.copy(deep=True)
-    idx = pd.IndexSlice
-
-    persons_with_transactions = df.loc[:, ['event', 'id', 'amount']].groupby(
-        by=['event', 'id']).count()
-    persons_with_transactions = persons_with_transactions.loc[idx['transaction', :], :].sort_values(
-        'amount').reset_index(level=0, drop=True).reset_index()
-    persons_with_transactions = persons_with_transactions['id']
-    return list(persons_with_transactions)
+    codes, users = pd.factorize(transcript['id'], sort=True)
+    return list(users[transaction_user_mask(transcript, users)])
 
 def get_default_user(profile):
     """
@@ -111,9 +134,7 @@ def get_default_user(profile):
     :param profile:
     :return: list of userids
     """
-    df = profile.copy(deep=True)
-    df = df.loc[df['gender'].isna(),:]
-    return list(df['id'])
+    return list(profile['id'][default_user_mask(profile)])
 
 def get_non_informing_users(transcript, profile):
     """
@@ -122,20 +143,93 @@ def get_non_informing_users(transcript, profile):
     :param profile:
     :return: list of user ids
     """
-    default_users = get_default_user(profile)
-    transaction_users = get_users_with_transactions(transcript)
-    users_without_transactions = profile.loc[~profile['id'].isin(transaction_users),:]
-    default_users_without_transactions = users_without_transactions.loc[users_without_transactions['id'].isin(default_users),'id']
-    return list(default_users_without_transactions)
+    return list(profile['id'][non_informing_user_mask(transcript, profile)])
+
 
+# User masks are boolean arrays aligned with an array of unique user ids, e.g. the rows of the profile. Masks over the
+# same users compose with & | ~, event_mask() selects the transcript events of the masked users.
 
+def user_codes(transcript, users):
+    """
+    Returns the position in users of the user of every event, -1 for users not in users
+    :param transcript: dataframe with an 'id' column
+    :param users: array of unique user ids
+    """
+    return pd.Categorical(transcript['id'], categories=pd.Index(users)).codes
+
+
+def user_transaction_counts(transcript, users):
+    """
+    Returns the number of transactions of every user in users
+    """
+    codes = user_codes(transcript, users)
+    codes = codes[np.asarray(transcript['event'] == 'transaction') & (codes >= 0)]
+    return np.bincount(codes, minlength=len(users))
+
+
+def transaction_user_mask(transcript, users, min_transactions=1):
+    """
+    Returns a mask of the users with at least min_transactions transactions
+    """
+    return user_transaction_counts(transcript, users) >= min_transactions
 
 
-def _value_return(x, wanted_key = []):
-    for key in x['value_keys']:
-        if key in wanted_key:
-            return x['value'][key]
-    return np.nan
+def default_user_mask(profile):
+    """
+    Returns a mask of the profile rows with the default profile: None gender, 118 age and nan income
+    """
+    return np.asarray(profile['gender'].isna())
+
+
+@instrumented('non_informing_user_mask')
+def non_informing_user_mask(transcript, profile):
+    """
+    Returns a mask of the profile rows of users which are both default values and have no transactions in transcript
+    """
+    mask = default_user_mask(profile) & ~transaction_user_mask(transcript, profile['id'])
+    annotate(non_informing_users=int(mask.sum()))
+    return mask
+
+
+def event_mask(transcript, users, user_mask):
+    """
+    Returns a mask of the transcript events of the users selected by user_mask, events of users not in users are
+    not selected
+    """
+    codes = user_codes(transcript, users)
+    return np.append(np.asarray(user_mask, dtype=bool), False)[codes]
+
+
+def _copy(df):
+    """
+    Returns a copy of df for the cleaning functions to modify. With copy-on-write, the default from pandas 3 on, a
+    shallow copy is enough: columns are only copied if the copy writes to them, so the input is never changed.
+    """
+    return df.copy(deep=not _copy_on_write())
+
+
+def _copy_on_write():
+    if int(pd.__version__.split('.')[0]) >= 3:
+        return True
+    try:
+        return pd.get_option('mode.copy_on_write') is True
+    except KeyError:  # pandas before 1.5 has no copy-on-write
+        return False
+
+
+def split_values(values):
+    """
+    Extracts offer id, amount and reward from the value dicts in a single pass.
+    Older events use the key 'offer id' instead of 'offer_id'. Missing keys are filled with nan.
+    :param values: iterable of value dicts
+    :return: tuple of arrays (offer_id, amount, reward)
+    """
+    rows = [(value.get('offer_id', value.get('offer id', np.nan)), value.get('amount', np.nan),
+             value.get('reward', np.nan)) for value in values]
+    if len(rows) == 0:
+        return np.array([], dtype=object), np.array([], dtype=float), np.array([], dtype=float)
+    offer_id, amount, reward = zip(*rows)
+    return np.array(offer_id, dtype=object), np.array(amount, dtype=float), np.array(reward, dtype=float)
 
 
 #transcript_clean.to_parquet("transcript_clean.parquet", compression='GZIP')
\ No newline at end of file
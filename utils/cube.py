@@ -0,0 +1,242 @@
+"""
+Aggregate cube of the response metrics by gender, age bucket, income bucket, offer type and channel.
+
+Every cell of the cube holds, for every metric, the count, sum and sum of squares of the values and a histogram over
+bin edges shared by all cells. All statistics are additive, so rolling up dimensions is a groupby sum over the cells
+and the mean, standard deviation and quantiles of any slice are derived from the sums without going back to the
+matrices:
+
+    cube = build_cube(portfolio, offer_df, profile_expanded)
+    summary(rollup(select(cube, gender=['F', 'M']), ['gender', 'age_bucket']), ['spent_in_window_norm'])
+
+User metrics are stored in the cells of offer type 'all' and channel 'all', the spending per offer type in the cells
+of the offer type and channel 'all'. Offer metrics are stored once per channel of the offer and once in channel
+'all', so rolling up the channel selects channel 'all' rather than summing the channels.
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from utils.lazy import lazy_import
+from utils.segments import age_buckets, income_buckets
+
+pd = lazy_import('pandas')
+
+DIMENSIONS = ['gender', 'age_bucket', 'income_bucket', 'offer_type', 'channel']
+ALL = 'all'
+# users without gender are labelled N as in the analysis notebooks
+NO_GENDER = 'N'
+
+USER_METRICS = ['spent_in_window_norm', 'spent_no_window_norm', 'in_window_out_window_ratio']
+TYPE_METRICS = ['spent_in_type_norm']
+OFFER_METRICS = ['viewed', 'completed', 'amount_in_window', 'time_in_window']
+METRICS = USER_METRICS + TYPE_METRICS + OFFER_METRICS
+
+# cells: one row per non-empty cell with the dimensions and the columns <metric>__<stat> and <metric>__bin<k>
+# bin_edges: one row per metric with the histogram bin edges
+Cube = namedtuple('Cube', ['cells', 'bin_edges'])
+
+
+def build_cube(portfolio, offer_df, profile_expanded, n_bins=64):
+    """
+    Builds the cube from the matrices.
+    The histogram bins of every metric are equi-depth over all values, so quantiles are estimated to within about
+    1/n_bins of the overall distribution. Metrics with few distinct values, like the flags, get fewer bins.
+    :param portfolio: cleaned portfolio dataframe, with the channel_* dummies
+    :param offer_df: offer matrix built by build_offer_df
+    :param profile_expanded: expanded profile built by build_user_df
+    :param n_bins: number of histogram bins per metric
+    :return: Cube
+    """
+    facts = cube_facts(portfolio, offer_df, profile_expanded)
+    cells, cell_codes = _factorize_cells(facts)
+    edges = {}
+    statistics = {}
+    for metric in METRICS:
+        values = np.asarray(facts[metric], dtype=float)
+        valid = np.isfinite(values)
+        edges[metric] = _quantile_edges(values[valid], n_bins)
+        cell = cell_codes[valid]
+        values = values[valid]
+        statistics[metric + '__count'] = np.bincount(cell, minlength=len(cells)).astype(float)
+        statistics[metric + '__sum'] = np.bincount(cell, weights=values, minlength=len(cells))
+        statistics[metric + '__sum_sq'] = np.bincount(cell, weights=values ** 2, minlength=len(cells))
+        n_columns = 2 * n_bins + 1
+        bins = _histogram_bins(edges[metric], values)
+        histogram = np.bincount(cell * n_columns + bins, minlength=len(cells) * n_columns).reshape(len(cells),
+                                                                                                  n_columns)
+        for k in range(n_columns):
+            statistics['{}__bin{}'.format(metric, k)] = histogram[:, k].astype(float)
+    cells = pd.concat([cells, pd.DataFrame(statistics)], axis=1)
+    bin_edges = pd.DataFrame.from_dict(edges, orient='index', columns=['edge{}'.format(k) for k in range(n_bins + 1)])
+    return Cube(cells, bin_edges)
+
+
+def cube_facts(portfolio, offer_df, profile_expanded):
+    """
+    Returns the fact rows of the cube: the dimensions and the metrics, nan where a metric does not apply to the row
+    """
+    users = user_dimensions(profile_expanded)
+
+    spent_in_window_norm = np.asarray(profile_expanded['spent_in_window'] / profile_expanded['time_in_window'])
+    spent_no_window_norm = np.asarray(profile_expanded['spent_no_window'] / profile_expanded['time_no_window'])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = spent_in_window_norm / spent_no_window_norm
+    user_facts = users.assign(offer_type=ALL, channel=ALL, spent_in_window_norm=spent_in_window_norm,
+                              spent_no_window_norm=spent_no_window_norm,
+                              in_window_out_window_ratio=np.where(np.isfinite(ratio), ratio, np.nan))
+
+    type_facts = [users.assign(offer_type=kind, channel=ALL, spent_in_type_norm=np.asarray(
+        profile_expanded['spent_in_' + kind] / profile_expanded['time_in_' + kind]))
+        for kind in ['bogo', 'discount', 'informational']]
+
+    offers = pd.DataFrame({'user_id': np.asarray(offer_df['user_id'], dtype=object),
+                           'offer_id': np.asarray(offer_df['offer_id'], dtype=object),
+                           'offer_type': np.asarray(offer_df['offer_type'], dtype=object)})
+    for metric in OFFER_METRICS:
+        offers[metric] = np.asarray(offer_df[metric], dtype=float)
+    offers = offers.merge(users, on='user_id')
+    channel_columns = [column for column in portfolio.columns if column.startswith('channel_')]
+    offer_channels = portfolio.melt(id_vars='id', value_vars=channel_columns, var_name='channel')
+    offer_channels = offer_channels.loc[offer_channels['value'] == 1, ['id', 'channel']]
+    offer_channels['channel'] = offer_channels['channel'].str[len('channel_'):]
+    per_channel = offers.merge(offer_channels.rename(columns={'id': 'offer_id'}), on='offer_id')
+    offer_facts = [per_channel, offers.assign(channel=ALL)]
+
+    facts = pd.concat([user_facts] + type_facts + offer_facts, ignore_index=True, sort=False)
+    return facts.loc[:, DIMENSIONS + METRICS]
+
+
+def user_dimensions(profile_expanded):
+    """
+    Returns the user id, gender, age bucket and income bucket of every user
+    """
+    gender = pd.Series(np.asarray(profile_expanded['gender'], dtype=object)).fillna(NO_GENDER)
+    return pd.DataFrame({'user_id': np.asarray(profile_expanded['user_id'], dtype=object),
+                         'gender': np.asarray(gender, dtype=object),
+                         'age_bucket': np.asarray(age_buckets(profile_expanded['age']), dtype=object),
+                         'income_bucket': np.asarray(income_buckets(profile_expanded['income']), dtype=object)})
+
+
+def select(cube, **members):
+    """
+    Returns the cube restricted to the given members of the dimensions, e.g. select(cube, gender='F') or
+    select(cube, offer_type=['bogo', 'discount'])
+    """
+    keep = np.ones(len(cube.cells), dtype=bool)
+    for dimension, values in members.items():
+        if dimension not in DIMENSIONS:
+            raise ValueError("unknown dimension {}, expected one of {}".format(dimension, DIMENSIONS))
+        values = [values] if isinstance(values, str) else list(values)
+        keep &= np.asarray(cube.cells[dimension].isin(values))
+    return Cube(cube.cells.loc[keep].reset_index(drop=True), cube.bin_edges)
+
+
+def rollup(cube, dimensions=()):
+    """
+    Returns the cube aggregated over all dimensions not in dimensions.
+    Rolling up the channel keeps channel 'all', offers would be counted once per channel otherwise.
+    """
+    dimensions = list(dimensions)
+    unknown = [dimension for dimension in dimensions if dimension not in DIMENSIONS]
+    if unknown:
+        raise ValueError("unknown dimensions {}, expected some of {}".format(unknown, DIMENSIONS))
+    cells = cube.cells
+    if 'channel' not in dimensions:
+        cells = cells.loc[cells['channel'] == ALL]
+    statistics = [column for column in cells.columns if column not in DIMENSIONS]
+    if dimensions:
+        cells = cells.groupby(dimensions, sort=True)[statistics].sum().reset_index()
+    else:
+        cells = cells[statistics].sum().to_frame().T
+    return Cube(cells, cube.bin_edges)
+
+
+def summary(cube, metrics=None, quantiles=(0.5,)):
+    """
+    Returns count, mean, std and quantiles of the metrics for every cell, like DataFrame.describe on the facts.
+    The quantiles are interpolated within the histogram bins.
+    :param cube: Cube, usually rolled up to the dimensions of interest
+    :param metrics: list of metrics, all metrics if None
+    :param quantiles: quantiles to estimate
+    :return: pd.DataFrame indexed by the dimensions of the cube, with (metric, statistic) columns
+    """
+    metrics = METRICS if metrics is None else list(metrics)
+    dimensions = [dimension for dimension in DIMENSIONS if dimension in cube.cells.columns]
+    columns = {}
+    for metric in metrics:
+        count = np.asarray(cube.cells[metric + '__count'])
+        total = np.asarray(cube.cells[metric + '__sum'])
+        total_sq = np.asarray(cube.cells[metric + '__sum_sq'])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mean = total / count
+            # sample standard deviation, as describe()
+            std = np.sqrt(np.maximum(total_sq - count * mean ** 2, 0) / (count - 1))
+        columns[(metric, 'count')] = count
+        columns[(metric, 'mean')] = mean
+        columns[(metric, 'std')] = np.where(count > 1, std, np.nan)
+        histogram = cube.cells.loc[:, [column for column in cube.cells.columns
+                                       if column.startswith(metric + '__bin')]].to_numpy()
+        edges = cube.bin_edges.loc[metric].to_numpy(dtype=float)
+        for q in quantiles:
+            columns[(metric, '{:g}%'.format(q * 100))] = _histogram_quantile(histogram, edges, q)
+    result = pd.DataFrame(columns)
+    if dimensions:
+        result.index = pd.MultiIndex.from_frame(cube.cells.loc[:, dimensions])
+    return result
+
+
+def _factorize_cells(facts):
+    """
+    Returns the distinct cells of the facts as a dataframe of the dimensions, and the cell of every fact row
+    """
+    codes = np.zeros(len(facts), dtype=np.int64)
+    levels = []
+    for dimension in DIMENSIONS:
+        dimension_codes, uniques = pd.factorize(facts[dimension], sort=True)
+        codes = codes * len(uniques) + dimension_codes
+        levels.append(uniques)
+    cell_codes, cell_keys = pd.factorize(codes, sort=True)
+    cells = {}
+    for dimension, uniques in zip(reversed(DIMENSIONS), reversed(levels)):
+        cells[dimension] = np.asarray(uniques, dtype=object)[cell_keys % len(uniques)]
+        cell_keys = cell_keys // len(uniques)
+    return pd.DataFrame({dimension: cells[dimension] for dimension in DIMENSIONS}), cell_codes
+
+
+def _quantile_edges(values, n_bins):
+    """
+    Returns the distinct values of the n_bins + 1 quantiles of values, padded with inf to n_bins + 1 edges
+    """
+    edges = np.unique(np.quantile(values, np.linspace(0, 1, n_bins + 1))) if len(values) else np.zeros(1)
+    return np.concatenate((edges, np.full(n_bins + 1 - len(edges), np.inf)))
+
+
+def _histogram_bins(edges, values):
+    """
+    Returns the histogram bin of every value. Bin 2k counts the values equal to edge k and bin 2k + 1 the values
+    between edge k and edge k + 1, so values repeated a lot, like the zeros of amount_in_window, are kept exact.
+    """
+    position = np.minimum(np.searchsorted(edges, values, side='left'), len(edges) - 1)
+    at_edge = edges[position] == values
+    return np.where(at_edge, 2 * position, 2 * position - 1)
+
+
+def _histogram_quantile(histogram, edges, q):
+    """
+    Estimates the q quantile of every row of histogram, assuming the values are uniform between two edges
+    """
+    counts = histogram.sum(axis=1)
+    cumulative = np.cumsum(histogram, axis=1)
+    target = q * counts
+    bins = np.minimum((cumulative < target[:, None]).sum(axis=1), histogram.shape[1] - 1)
+    rows = np.arange(len(histogram))
+    before = np.where(bins > 0, cumulative[rows, np.maximum(bins - 1, 0)], 0)
+    in_bin = histogram[rows, bins]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        fraction = np.where(in_bin > 0, (target - before) / in_bin, 0)
+    lower = edges[bins // 2]
+    upper = edges[np.minimum(bins // 2 + 1, len(edges) - 1)]
+    between = (bins % 2 == 1) & np.isfinite(upper)
+    quantile = np.where(between, lower + fraction * (upper - lower), lower)
+    return np.where(counts > 0, quantile, np.nan)
@@ -0,0 +1,104 @@
+import numpy as np
+
+from utils.build_matrices import add_gender_dummies, add_offer_type_dummies, build_offer_rows, build_user_df
+from utils.lazy import lazy_import
+from utils.schema import OFFER_SCHEMA, PROFILE_EXPANDED_DUMMIES, PROFILE_EXPANDED_SCHEMA, apply_schema
+
+pd = lazy_import('pandas')
+
+# columns of a cleaned transcript that make up the fingerprint of a user's events
+FINGERPRINT_COLUMNS = ['event', 'time', 'offer_id', 'amount', 'reward']
+
+
+def user_fingerprints(transcript):
+    """
+    Returns the number of events and an order independent hash of the events of every user in the transcript
+    :param transcript: cleaned transcript dataframe
+    :return: pd.DataFrame with the columns id, fingerprint and n_events
+    """
+    codes, users = pd.factorize(transcript['id'])
+    hashes = pd.util.hash_pandas_object(transcript.loc[:, FINGERPRINT_COLUMNS], index=False).values
+    fingerprint = np.zeros(len(users), dtype=np.uint64)
+    np.add.at(fingerprint, codes, hashes)
+    return pd.DataFrame({'id': np.asarray(users, dtype=object),
+                         'fingerprint': fingerprint,
+                         'n_events': np.bincount(codes, minlength=len(users))})
+
+
+def changed_users(previous, current):
+    """
+    Returns the ids of users whose events were added, changed or removed between two user_fingerprints() results
+    """
+    merged = pd.merge(previous, current, on='id', how='outer', suffixes=('_previous', '_current'))
+    changed = (merged['fingerprint_previous'] != merged['fingerprint_current']) | \
+              (merged['n_events_previous'] != merged['n_events_current'])
+    return np.asarray(merged.loc[changed, 'id'], dtype=object)
+
+
+def changed_profiles(previous, current):
+    """
+    Returns the ids of users whose profile row was added or changed between two cleaned profiles
+    """
+    def fingerprints(profile):
+        hashes = pd.util.hash_pandas_object(profile.drop(columns='id'), index=False).values
+        return pd.DataFrame({'id': np.asarray(profile['id'], dtype=object), 'fingerprint': hashes})
+
+    if list(previous.columns) != list(current.columns):
+        return np.asarray(current['id'], dtype=object)
+    merged = pd.merge(fingerprints(previous), fingerprints(current), on='id', how='right',
+                      suffixes=('_previous', '_current'))
+    changed = merged['fingerprint_previous'] != merged['fingerprint_current']
+    return np.asarray(merged.loc[changed, 'id'], dtype=object)
+
+
+def update_matrices(portfolio, profile, transcript, offer_df, profile_expanded, previous_fingerprints,
+                    previous_profile=None):
+    """
+    Updates offer_df and profile_expanded after events were appended to the transcript.
+    Only the offer rows and the expanded profile rows of users with new or changed events, and of users new to the
+    profile or whose profile row changed, are rebuilt. The portfolio must be the one of the previous build. Offers
+    that were still open at the previous build can only change through a new event of the same user, so rebuilding
+    every user with new events keeps their view, completion and window state exact.
+    time_no_window depends on the end of the transcript and is recomputed for all users. The result is identical to a
+    full build with build_offer_df and build_user_df.
+    :param portfolio: cleaned portfolio dataframe
+    :param profile: cleaned profile dataframe
+    :param transcript: full cleaned transcript, including the new events
+    :param offer_df: offer matrix of the previous build
+    :param profile_expanded: expanded profile of the previous build
+    :param previous_fingerprints: user_fingerprints() of the transcript of the previous build
+    :param previous_profile: cleaned profile of the previous build, if None the profile rows are assumed unchanged
+    :return: (offer_df, profile_expanded, fingerprints)
+    """
+    fingerprints = user_fingerprints(transcript)
+    users = profile['id'].unique()
+    dirty = np.union1d(changed_users(previous_fingerprints, fingerprints).astype(str),
+                       np.setdiff1d(np.asarray(users, dtype=str), np.asarray(profile_expanded['user_id'], dtype=str)))
+    if previous_profile is not None:
+        dirty = np.union1d(dirty, changed_profiles(previous_profile, profile).astype(str))
+    dirty_profile = profile.loc[profile['id'].isin(dirty)]
+    dirty_transcript = transcript.loc[transcript['id'].isin(dirty)]
+    max_time = transcript.loc[:, 'time'].max()
+
+    offer_rows, count_users_no_offer = build_offer_rows(portfolio, dirty_profile, dirty_transcript)
+    offer_columns = [column for column in offer_df.columns if not column.startswith('type_')]
+    kept_offers = offer_df.loc[~offer_df['user_id'].isin(dirty) & offer_df['user_id'].isin(users), offer_columns]
+    offers = apply_schema(pd.concat([kept_offers, offer_rows]), OFFER_SCHEMA)
+    # restore the order of a full build, users in profile order and offers in transcript order
+    user_position = pd.Categorical(offers['user_id'], categories=users).codes
+    offers = offers.iloc[np.argsort(user_position, kind='stable')]
+    offers.index = pd.Index(np.arange(len(offers)))
+    offers = add_offer_type_dummies(offers)
+
+    expanded_rows = build_user_df(portfolio, dirty_profile, dirty_transcript, offer_rows, max_time=max_time)
+    kept_users = profile_expanded.loc[~profile_expanded['user_id'].isin(dirty) &
+                                      profile_expanded['user_id'].isin(users)].copy()
+    # time_in_window is the covered time + 1 and time_no_window is max_time - covered time + 1
+    kept_users['time_no_window'] = max_time - (kept_users['time_in_window'] - 1) + 1
+    gender_columns = [column for column in profile_expanded.columns if column.startswith('gender_')]
+    if gender_columns:
+        expanded_rows = add_gender_dummies(expanded_rows).reindex(columns=profile_expanded.columns,
+                                                                  fill_value=False)
+    expanded = pd.concat([kept_users, expanded_rows]).sort_values('user_id').reset_index(drop=True)
+    expanded = apply_schema(expanded, PROFILE_EXPANDED_SCHEMA, dummies=PROFILE_EXPANDED_DUMMIES)
+    return offers, expanded, fingerprints
@@ -0,0 +1,177 @@
+"""
+Opt-in instrumentation of the pipeline stages.
+
+Every instrumented stage emits one record, a dict with the stage name, wall time in seconds, rows in and out, the
+peak resident memory of the process and stage specific counts, to the sink set with set_sink(). A sink is any
+callable taking the record:
+
+    records = []
+    set_sink(records.append)                 # in memory, e.g. for tests
+    set_sink(log_sink())                     # log through the logging module
+    set_sink(json_lines_sink('stages.json')) # append json lines to a file
+
+Stages are instrumented with the stage() context manager or the instrumented() decorator, annotate() adds counts to
+the record of the running stage. Without a sink, stage() only
+yields a throwaway dict and instrumented() calls straight through, so instrumentation costs next to nothing.
+"""
+import functools
+import json
+import logging
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+_sink = None
+# records of the stages currently running in the calling thread, innermost last
+_local = threading.local()
+# serialises the sink calls of stages finishing in different threads
+_sink_lock = threading.Lock()
+
+
+def set_sink(sink):
+    """
+    Sets the callable receiving the stage records, None turns instrumentation off
+    :return: the previous sink
+    """
+    global _sink
+    previous, _sink = _sink, sink
+    return previous
+
+
+def enabled():
+    """
+    Returns True when a sink is set
+    """
+    return _sink is not None
+
+
+@contextmanager
+def stage(name, rows_in=None):
+    """
+    Context manager timing a pipeline stage and emitting its record to the sink.
+    The yielded dict is the record, the stage can add rows_out and other counts to it.
+    :param name: name of the stage
+    :param rows_in: number of input rows
+    """
+    if _sink is None:
+        yield {}
+        return
+    record = {'stage': name, 'rows_in': rows_in, 'rows_out': None}
+    start = time.perf_counter()
+    _active_stages().append(record)
+    try:
+        yield record
+    finally:
+        _active_stages().pop()
+        record['seconds'] = time.perf_counter() - start
+        record['peak_rss_bytes'] = peak_rss()
+        with _sink_lock:
+            _sink(record)
+
+
+def instrumented(name, rows_arg=0):
+    """
+    Decorator running a function as a stage. Rows in are counted from a positional argument, rows out from the result.
+    :param name: name of the stage
+    :param rows_arg: position of the argument whose rows are counted as rows in
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if _sink is None:
+                return func(*args, **kwargs)
+            with stage(name, rows_in=_count_rows(args[rows_arg]) if len(args) > rows_arg else None) as record:
+                result = func(*args, **kwargs)
+                record['rows_out'] = _count_rows(result)
+            return result
+        return wrapper
+    return decorate
+
+
+def annotate(**counts):
+    """
+    Adds stage specific counts to the record of the innermost running stage, does nothing when no stage is recorded
+    """
+    active = _active_stages()
+    if active:
+        active[-1].update(counts)
+
+
+def _active_stages():
+    """
+    Returns the stack of running stages of the calling thread, so stages running in worker threads do not nest
+    """
+    if not hasattr(_local, 'stages'):
+        _local.stages = []
+    return _local.stages
+
+
+def _count_rows(value):
+    """
+    Returns the number of rows of a dataframe or sequence, of the last item for tuples of dataframes
+    """
+    if isinstance(value, tuple) and len(value) > 0:
+        value = value[-1]
+    return len(value) if hasattr(value, '__len__') else None
+
+
+def latency_histogram(seconds, n_bins=10):
+    """
+    Returns a histogram of latencies with logarithmic bins, as a json serialisable dict
+    """
+    seconds = np.asarray(seconds, dtype=float)
+    seconds = seconds[seconds > 0]
+    if len(seconds) == 0:
+        return {'bin_edges': [], 'counts': []}
+    edges = np.geomspace(seconds.min(), seconds.max() * (1 + 1e-9), n_bins + 1)
+    counts, edges = np.histogram(seconds, bins=edges)
+    return {'bin_edges': edges.tolist(), 'counts': counts.tolist()}
+
+
+def peak_rss():
+    """
+    Returns the peak resident memory of the process in bytes, None where it is not available
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes elsewhere
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def log_sink(logger=None, level=logging.INFO):
+    """
+    Returns a sink logging every record as one line
+    """
+    logger = logger or logging.getLogger('utils.instrumentation')
+
+    def sink(record):
+        logger.log(level, '%s', json.dumps(record, default=_to_json))
+    return sink
+
+
+def json_lines_sink(path):
+    """
+    Returns a sink appending every record to path as a json line
+    """
+    def sink(record):
+        with open(path, 'a') as f:
+            f.write(json.dumps(record, default=_to_json) + '\n')
+    return sink
+
+
+def _to_json(value):
+    """
+    Converts NumPy scalars in records to python numbers
+    """
+    if isinstance(value, np.generic):
+        return value.item()
+    raise TypeError('{!r} is not json serialisable'.format(value))
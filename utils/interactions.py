@@ -0,0 +1,92 @@
+"""
+Sparse user x offer interaction matrices.
+
+offer_df is reduced to one scipy.sparse CSR matrix per signal with a row per user and a column per portfolio offer:
+the number of times the offer was received, viewed and completed, and the amount spent in its windows.
+
+    interactions = build_interactions(offer_df, portfolio, users=profile['id'])
+    save_interactions(interactions, 'interactions')
+    received = load_interactions('interactions').matrices['received']
+
+The users and offers arrays are the index maps: row k is users[k] and column j is offers[j], in profile and portfolio
+order, so matrices saved from different builds on the same data line up.
+"""
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from utils.lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+# signal name to (offer_df column, dtype of the matrix), counts are summed over the offers received
+SIGNALS = {'received': (None, np.int32),
+           'viewed': ('viewed', np.int32),
+           'completed': ('completed', np.int32),
+           'amount_in_window': ('amount_in_window', np.float64)}
+
+# users and offers: ids of the rows and columns, matrices: dict of signal name to CSR matrix
+InteractionMatrices = namedtuple('InteractionMatrices', ['users', 'offers', 'matrices'])
+
+
+def build_interactions(offer_df, portfolio, users=None):
+    """
+    Builds the interaction matrices of offer_df
+    :param offer_df: offer matrix built by build_offer_df
+    :param portfolio: portfolio dataframe, its ids are the columns
+    :param users: user ids of the rows, e.g. profile['id'], the sorted user ids of offer_df if None. Offers of other
+        users are left out
+    :return: InteractionMatrices
+    """
+    from scipy import sparse
+
+    if users is None:
+        users = np.sort(np.unique(np.asarray(offer_df['user_id'], dtype=str)))
+    users = np.asarray(users, dtype=str)
+    offers = np.asarray(portfolio['id'], dtype=str)
+    rows = pd.Categorical(np.asarray(offer_df['user_id'], dtype=object), categories=users).codes
+    columns = pd.Categorical(np.asarray(offer_df['offer_id'], dtype=object), categories=offers).codes
+    if np.any(columns < 0):
+        unknown = np.asarray(offer_df['offer_id'], dtype=object)[columns < 0]
+        raise KeyError("offer ids not in portfolio: {}".format(np.unique(unknown.astype(str))))
+    keep = rows >= 0
+    rows, columns = rows[keep], columns[keep]
+
+    matrices = {}
+    for signal, (column, dtype) in SIGNALS.items():
+        values = np.ones(len(rows), dtype=dtype) if column is None else \
+            np.asarray(offer_df[column], dtype=dtype)[keep]
+        # duplicates of a (user, offer) pair are summed by the conversion to CSR
+        matrix = sparse.csr_matrix((values, (rows, columns)), shape=(len(users), len(offers)), dtype=dtype)
+        matrix.eliminate_zeros()
+        matrices[signal] = matrix
+    return InteractionMatrices(users, offers, matrices)
+
+
+def save_interactions(interactions, directory):
+    """
+    Writes every matrix as <signal>.npz and the index maps as users.npy and offers.npy
+    """
+    from scipy import sparse
+
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, 'users.npy'), interactions.users)
+    np.save(os.path.join(directory, 'offers.npy'), interactions.offers)
+    for signal, matrix in interactions.matrices.items():
+        sparse.save_npz(os.path.join(directory, signal + '.npz'), matrix)
+
+
+def load_interactions(directory, signals=None):
+    """
+    Reads matrices written by save_interactions
+    :param signals: names of the matrices to read, all of SIGNALS if None
+    :return: InteractionMatrices
+    """
+    from scipy import sparse
+
+    users = np.load(os.path.join(directory, 'users.npy'))
+    offers = np.load(os.path.join(directory, 'offers.npy'))
+    matrices = {signal: sparse.load_npz(os.path.join(directory, signal + '.npz')).tocsr()
+                for signal in (SIGNALS if signals is None else signals)}
+    return InteractionMatrices(users, offers, matrices)
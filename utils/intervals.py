@@ -0,0 +1,86 @@
+import numpy as np
+
+
+def search_group_times(sorted_groups, sorted_times, groups, times, side='left'):
+    """
+    Vectorised np.searchsorted over items sorted by (group, time)
+    :param sorted_groups: integer group of every item, sorted
+    :param sorted_times: time of every item, sorted within each group
+    :param groups: group of every query
+    :param times: time of every query
+    :param side: 'left' or 'right', as for np.searchsorted
+    :return: insertion index of every query
+    """
+    if len(sorted_times) == 0 or len(times) == 0:
+        return np.zeros(len(times), dtype=int)
+    # small integer times, as produced by utils.loading, are widened so the keys cannot overflow
+    sorted_times = np.asarray(sorted_times, dtype=np.result_type(sorted_times, np.int64))
+    times = np.asarray(times, dtype=np.result_type(times, np.int64))
+    lowest = min(np.min(sorted_times), np.min(times))
+    span = max(np.max(sorted_times), np.max(times)) - lowest + 1
+    keys = np.asarray(sorted_groups, dtype=np.int64) * span + (sorted_times - lowest)
+    return np.searchsorted(keys, np.asarray(groups, dtype=np.int64) * span + (times - lowest), side=side)
+
+
+def merge_group_intervals(groups, starts, ends):
+    """
+    Merges overlapping closed intervals [start, end] within each group.
+    Intervals with a nan start or end are ignored. The intervals are sorted by (group, start) and merged in one sweep
+    with a cumulative max of the interval ends.
+    :param groups: non negative integer group of every interval, for instance a user code
+    :param starts: start of every interval
+    :param ends: end of every interval
+    :return: (groups, starts, ends) of the merged intervals, sorted by group and start
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    starts = np.asarray(starts, dtype=float)
+    ends = np.asarray(ends, dtype=float)
+    valid = ~(np.isnan(starts) | np.isnan(ends))
+    groups, starts, ends = groups[valid], starts[valid], ends[valid]
+    if len(groups) == 0:
+        return groups, starts, ends
+    order = np.lexsort((starts, groups))
+    groups, starts, ends = groups[order], starts[order], ends[order]
+
+    # running max of the ends within each group, groups are offset so a cummax never crosses into the next group
+    lowest = min(starts.min(), ends.min())
+    span = max(starts.max(), ends.max()) - lowest + 1
+    running_end = np.maximum.accumulate(groups * span + (ends - lowest)) - groups * span + lowest
+
+    new_interval = np.ones(len(groups), dtype=bool)
+    new_interval[1:] = (groups[1:] != groups[:-1]) | (starts[1:] > running_end[:-1])
+    first = np.flatnonzero(new_interval)
+    last = np.append(first[1:], len(groups)) - 1
+    return groups[first], starts[first], running_end[last]
+
+
+def group_coverage(groups, starts, ends, n_groups):
+    """
+    Returns the total length covered by the union of the intervals of every group
+    :param n_groups: number of groups, groups are 0 to n_groups - 1
+    :return: array of length n_groups
+    """
+    merged_groups, merged_starts, merged_ends = merge_group_intervals(groups, starts, ends)
+    return np.bincount(merged_groups, weights=merged_ends - merged_starts, minlength=n_groups)
+
+
+def in_group_intervals(groups, starts, ends, point_groups, point_times):
+    """
+    Labels every point that falls inside any closed interval of its group
+    :param groups: group of every interval
+    :param starts: start of every interval
+    :param ends: end of every interval
+    :param point_groups: group of every point
+    :param point_times: time of every point
+    :return: boolean array, True for points inside an interval
+    """
+    merged_groups, merged_starts, merged_ends = merge_group_intervals(groups, starts, ends)
+    point_groups = np.asarray(point_groups, dtype=np.int64)
+    point_times = np.asarray(point_times, dtype=float)
+    if len(merged_groups) == 0:
+        return np.zeros(len(point_times), dtype=bool)
+    # last merged interval starting at or before the point
+    candidate = search_group_times(merged_groups, merged_starts, point_groups, point_times, side='right') - 1
+    inside = candidate >= 0
+    candidate = np.maximum(candidate, 0)
+    return inside & (merged_groups[candidate] == point_groups) & (merged_ends[candidate] >= point_times)
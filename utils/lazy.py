@@ -0,0 +1,38 @@
+"""
+Deferred imports of heavy dependencies.
+
+    pd = lazy_import('pandas')
+
+binds pd to a module object which is only executed on the first attribute access, so importing a module of utils
+does not import pandas until one of its functions uses it. benchmarks/import_time.py checks the cold-start budget.
+importlib.util.LazyLoader is not thread-safe before Python 3.12.3, code that uses a lazy module from several threads
+calls resolve() on it before starting them.
+"""
+import importlib.util
+import sys
+
+
+def lazy_import(name):
+    """
+    Returns the module name, executed on first attribute access if it is not imported yet
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError("No module named '{}'".format(name), name=name)
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def resolve(module):
+    """
+    Executes a module returned by lazy_import if it has not been executed yet and returns it
+    """
+    # any attribute access executes a lazy module
+    module.__name__
+    return module
@@ -0,0 +1,150 @@
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+
+import numpy as np
+
+from utils.cleaning import clean_data, split_values
+from utils.lazy import lazy_import, resolve
+
+pd = lazy_import('pandas')
+
+EVENTS = ['offer received', 'offer viewed', 'offer completed', 'transaction']
+# columns of a cleaned transcript and the dtypes they are parsed into, categorical columns are held as codes
+COLUMN_DTYPES = {'id': np.int32, 'event': np.int8, 'time': np.int32, 'offer_id': np.int32, 'amount': np.float32,
+                 'reward': np.float32}
+
+
+def load_all(data_dir='data', chunksize=100000):
+    """
+    Loads portfolio, profile and transcript from the json lines files in data_dir.
+    The transcript is streamed in chunks and returned in compact columns, see load_transcript. The result can be
+    passed straight to clean_data.
+    :param data_dir: directory of portfolio.json, profile.json and transcript.json
+    :param chunksize: number of transcript lines parsed at a time
+    :return: (portfolio, profile, transcript)
+    """
+    portfolio = pd.read_json(os.path.join(data_dir, 'portfolio.json'), orient='records', lines=True)
+    profile = pd.read_json(os.path.join(data_dir, 'profile.json'), orient='records', lines=True)
+    transcript = load_transcript(os.path.join(data_dir, 'transcript.json'), users=profile['id'],
+                                 offers=portfolio['id'], chunksize=chunksize)
+    return portfolio, profile, transcript
+
+
+def load_clean_all(data_dir='data', chunksize=100000, n_workers=3, buckets=False):
+    """
+    Loads and cleans portfolio, profile and transcript concurrently, the result equals
+    clean_data(*load_all(data_dir)).
+    Portfolio and profile are read in worker threads while the transcript is parsed in another, then the three are
+    cleaned by clean_data with the same n_workers. The transcript is parsed without the profile and portfolio ids,
+    its categories are reordered afterwards to start with them as load_transcript orders them.
+    :param data_dir: directory of portfolio.json, profile.json and transcript.json
+    :param chunksize: number of transcript lines parsed at a time
+    :param n_workers: number of threads, 1 loads and cleans the files one after another
+    :param buckets: if True, the profile gets the segment buckets, see clean_profile_data
+    :return: (portfolio, profile, transcript)
+    """
+    def read(name):
+        return pd.read_json(os.path.join(data_dir, name), orient='records', lines=True)
+
+    resolve(pd)
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        transcript = executor.submit(load_transcript, os.path.join(data_dir, 'transcript.json'), chunksize=chunksize)
+        portfolio = executor.submit(read, 'portfolio.json')
+        profile = executor.submit(read, 'profile.json')
+        portfolio, profile, transcript = portfolio.result(), profile.result(), transcript.result()
+
+    transcript['id'] = _lead_categories(transcript['id'], profile['id'])
+    transcript['offer_id'] = _lead_categories(transcript['offer_id'], portfolio['id'])
+    return clean_data(portfolio, profile, transcript, buckets=buckets, n_workers=n_workers)
+
+
+def load_transcript(path, users=(), offers=(), chunksize=100000):
+    """
+    Streams a transcript json lines file and parses it chunk by chunk into compact columns.
+    The value dicts are split into offer_id, amount and reward as clean_transcript does, so only one chunk of raw
+    records is held in memory at a time. The parsed chunks are written into columns preallocated for the number of
+    lines estimated from the file size, which grow by half when the estimate is short.
+    - id and offer_id are categoricals whose categories start with users and offers, so the codes are shared with the
+      profile and portfolio. Unseen ids are appended to the categories.
+    - event is a categorical of EVENTS
+    - time is int16 when it fits, int32 otherwise
+    - amount and reward are float32
+    :param path: path to transcript.json
+    :param users: user ids of the profile
+    :param offers: offer ids of the portfolio
+    :param chunksize: number of lines parsed at a time
+    :return: pd.DataFrame with the columns of a cleaned transcript
+    """
+    user_categories = {user: code for code, user in enumerate(users)}
+    offer_categories = {offer: code for code, offer in enumerate(offers)}
+    event_categories = {event: code for code, event in enumerate(EVENTS)}
+
+    columns = {column: np.empty(0, dtype=dtype) for column, dtype in COLUMN_DTYPES.items()}
+    n_rows = 0
+    with open(path) as f:
+        while True:
+            lines = list(islice(f, chunksize))
+            if len(lines) == 0:
+                break
+            if n_rows == 0:
+                # the number of lines is estimated from the length of the first lines and the size of the file
+                columns = _grow(columns, int(os.path.getsize(path) / max(sum(map(len, lines)), 1) * len(lines) * 1.05))
+            chunk = _parse_chunk(lines, user_categories, offer_categories, event_categories)
+            n_chunk = len(chunk['time'])
+            if n_rows + n_chunk > len(columns['time']):
+                columns = _grow(columns, max(n_rows + n_chunk, int(len(columns['time']) * 1.5)), n_rows)
+            for column, values in chunk.items():
+                columns[column][n_rows:n_rows + n_chunk] = values
+            n_rows += n_chunk
+
+    columns = {column: values[:n_rows] for column, values in columns.items()}
+    if len(columns['time']) == 0 or columns['time'].max() <= np.iinfo(np.int16).max:
+        columns['time'] = columns['time'].astype(np.int16)
+    columns['id'] = pd.Categorical.from_codes(columns['id'], categories=list(user_categories))
+    columns['event'] = pd.Categorical.from_codes(columns['event'], categories=list(event_categories))
+    columns['offer_id'] = pd.Categorical.from_codes(columns['offer_id'], categories=list(offer_categories))
+    return pd.DataFrame(columns, copy=False)
+
+
+def _grow(columns, capacity, n_rows=0):
+    """
+    Returns the columns reallocated to capacity rows, keeping their first n_rows values
+    """
+    grown = {}
+    for column, values in columns.items():
+        grown[column] = np.empty(capacity, dtype=values.dtype)
+        grown[column][:n_rows] = values[:n_rows]
+    return grown
+
+
+def _parse_chunk(lines, user_categories, offer_categories, event_categories):
+    """
+    Parses json lines into a dict of compact column arrays, categorical columns as integer codes
+    """
+    records = [json.loads(line) for line in lines if line.strip()]
+    offer_id, amount, reward = split_values(record['value'] for record in records)
+    return {'id': _encode([record['person'] for record in records], user_categories),
+            'event': _encode([record['event'] for record in records], event_categories).astype(np.int8),
+            'time': np.array([record['time'] for record in records], dtype=np.int32),
+            'offer_id': _encode(offer_id, offer_categories),
+            'amount': amount.astype(np.float32),
+            'reward': reward.astype(np.float32)}
+
+
+def _encode(values, categories):
+    """
+    Returns the integer codes of values, unseen values are appended to the categories dict. Missing values are -1.
+    """
+    return np.array([-1 if value is None or value != value else categories.setdefault(value, len(categories))
+                     for value in values], dtype=np.int32)
+
+
+def _lead_categories(values, leading):
+    """
+    Returns the categorical values with the categories leading first and the others after them in their order
+    """
+    categories = list(dict.fromkeys(list(leading) + list(values.cat.categories)))
+    codes = pd.Index(categories).get_indexer(values.cat.categories)
+    return pd.Categorical.from_codes(np.append(codes, -1)[values.cat.codes], categories=categories)
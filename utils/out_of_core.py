@@ -0,0 +1,197 @@
+"""
+Out-of-core build of offer_df and profile_expanded for transcripts larger than memory.
+
+The transcript json is streamed once and partitioned on disk by a hash of the user id, so all events of a user end
+up in the same partition. The partitions are then cleaned and built one at a time with the in-memory builders and
+the rows are written to a feather file per partition:
+
+    build_out_of_core('data', 'ooc', n_partitions=64)
+    offer_df = read_sink('ooc', 'offer_df')
+
+Memory is bounded by the largest partition, the profile and the id categories, not by the transcript. Every
+partition is independent of the others, so they can also be built by separate workers with build_partition().
+"""
+import json
+import logging
+import os
+import shutil
+from itertools import count, islice
+
+import numpy as np
+
+from utils.build_matrices import add_gender_dummies, add_offer_type_dummies, build_offer_rows, build_user_df
+from utils.cleaning import clean_data
+from utils.lazy import lazy_import
+from utils.loading import COLUMN_DTYPES, EVENTS, _parse_chunk
+from utils.schema import OFFER_SCHEMA, PROFILE_EXPANDED_SCHEMA, apply_schema
+
+pd = lazy_import('pandas')
+
+logger = logging.getLogger(__name__)
+
+SINKS = ['offer_df', 'profile_expanded']
+
+
+def build_out_of_core(data_dir, directory, n_partitions=16, chunksize=100000):
+    """
+    Partitions the transcript of data_dir and builds offer_df and profile_expanded partition by partition.
+    The partitions, sinks and metadata of a previous build in directory are removed first.
+    :param data_dir: directory of portfolio.json, profile.json and transcript.json
+    :param directory: directory of the partitions and of the offer_df and profile_expanded sinks
+    :param n_partitions: number of user partitions
+    :param chunksize: number of transcript lines parsed at a time
+    :return: dict of metadata: n_partitions, the last hour of the cleaned transcript and the number of users that
+        received no offer
+    """
+    portfolio = pd.read_json(os.path.join(data_dir, 'portfolio.json'), orient='records', lines=True)
+    profile = pd.read_json(os.path.join(data_dir, 'profile.json'), orient='records', lines=True)
+    for name in SINKS + ['meta.json']:
+        _remove(os.path.join(directory, name))
+    meta = partition_transcript(os.path.join(data_dir, 'transcript.json'), directory, n_partitions,
+                                users=profile['id'], offers=portfolio['id'], chunksize=chunksize)
+
+    profile_partitions = user_partitions(profile['id'], n_partitions)
+    max_time, count_users_no_offer = -1, 0
+    for partition in range(n_partitions):
+        partition_max, count = build_partition(portfolio, profile.loc[profile_partitions == partition], directory,
+                                               partition, max_time=meta['max_time'])
+        max_time = max(max_time, partition_max)
+        count_users_no_offer += count
+    logger.info("%d received no offer", count_users_no_offer)
+
+    # time_no_window depends on the last hour of the cleaned transcript, which is only known after all partitions
+    if max_time != meta['max_time']:
+        for path in _sink_paths(directory, 'profile_expanded'):
+            expanded = pd.read_feather(path)
+            expanded['time_no_window'] += max_time - meta['max_time']
+            _write_feather(expanded, path)
+    meta.update(max_time=max_time, users_no_offer=count_users_no_offer)
+    with open(os.path.join(directory, 'meta.json'), 'w') as f:
+        json.dump(meta, f)
+    return meta
+
+
+def partition_transcript(path, directory, n_partitions, users=(), offers=(), chunksize=100000):
+    """
+    Streams a transcript json lines file and appends every chunk, split by user partition, to
+    <directory>/partitions/<partition>/<chunk>.feather. The columns are the integer codes of utils.loading, the
+    categories are written to users.feather, offers.feather and events.feather. Partitions of a previous run are
+    removed first.
+    :return: dict with n_partitions and max_time, the last hour of the transcript
+    """
+    _remove(os.path.join(directory, 'partitions'))
+    user_categories = {user: code for code, user in enumerate(users)}
+    offer_categories = {offer: code for code, offer in enumerate(offers)}
+    event_categories = {event: code for code, event in enumerate(EVENTS)}
+    code_partitions = np.zeros(0, dtype=np.int64)
+    max_time = -1
+
+    with open(path) as f:
+        for chunk_number in count():
+            lines = list(islice(f, chunksize))
+            if len(lines) == 0:
+                break
+            chunk = _parse_chunk(lines, user_categories, offer_categories, event_categories)
+            if len(user_categories) > len(code_partitions):
+                new_users = list(islice(user_categories, len(code_partitions), None))
+                code_partitions = np.concatenate((code_partitions, user_partitions(new_users, n_partitions)))
+            chunk = pd.DataFrame(chunk)
+            max_time = max(max_time, int(chunk['time'].max()))
+            for partition, rows in chunk.groupby(code_partitions[chunk['id']], sort=True):
+                partition_directory = os.path.join(directory, 'partitions', str(partition))
+                os.makedirs(partition_directory, exist_ok=True)
+                _write_feather(rows.reset_index(drop=True),
+                               os.path.join(partition_directory, '{:08d}.feather'.format(chunk_number)))
+
+    for name, categories in [('users', user_categories), ('offers', offer_categories), ('events', event_categories)]:
+        _write_feather(pd.DataFrame({'id': list(categories)}), os.path.join(directory, name + '.feather'))
+    return {'n_partitions': n_partitions, 'max_time': max_time}
+
+
+def build_partition(portfolio, profile, directory, partition, max_time):
+    """
+    Cleans one transcript partition and writes its offer rows and expanded profile to the sinks
+    :param portfolio: raw portfolio dataframe
+    :param profile: raw profile rows of the users of the partition
+    :param directory: directory written by partition_transcript
+    :param partition: number of the partition
+    :param max_time: last hour of the transcript
+    :return: (last hour of the cleaned partition, number of users that received no offer)
+    """
+    transcript = read_partition(directory, partition)
+    portfolio, profile, transcript = clean_data(portfolio, profile, transcript)
+    offer_rows, count_users_no_offer = build_offer_rows(portfolio, profile, transcript)
+    expanded = build_user_df(portfolio, profile, transcript, offer_rows, max_time=max_time)
+    for name, table in [('offer_df', offer_rows), ('profile_expanded', expanded)]:
+        os.makedirs(os.path.join(directory, name), exist_ok=True)
+        _write_feather(table.reset_index(drop=True),
+                       os.path.join(directory, name, 'part-{:05d}.feather'.format(partition)))
+    partition_max = int(transcript['time'].max()) if len(transcript) else -1
+    return partition_max, count_users_no_offer
+
+
+def read_partition(directory, partition):
+    """
+    Returns the transcript of one partition in the columns of utils.loading.load_transcript
+    """
+    partition_directory = os.path.join(directory, 'partitions', str(partition))
+    files = sorted(os.listdir(partition_directory)) if os.path.isdir(partition_directory) else []
+    chunks = [pd.read_feather(os.path.join(partition_directory, name)) for name in files]
+    columns = {column: np.concatenate([np.asarray(chunk[column]) for chunk in chunks]) if chunks
+               else np.array([], dtype=dtype) for column, dtype in COLUMN_DTYPES.items()}
+    if len(columns['time']) == 0 or columns['time'].max() <= np.iinfo(np.int16).max:
+        columns['time'] = columns['time'].astype(np.int16)
+    for column, name in [('id', 'users'), ('offer_id', 'offers'), ('event', 'events')]:
+        categories = pd.read_feather(os.path.join(directory, name + '.feather'))['id']
+        columns[column] = pd.Categorical.from_codes(columns[column], categories=categories)
+    return pd.DataFrame(columns)
+
+
+def read_sink(directory, name, columns=None):
+    """
+    Reads offer_df or profile_expanded written by build_out_of_core, in the types of utils.schema and with the
+    offer type or gender dummies when all columns are read. Rows are in partition order.
+    :param columns: list of columns to read, all columns if None
+    """
+    if name not in SINKS:
+        raise ValueError("unknown sink {}, expected one of {}".format(name, SINKS))
+    table = pd.concat([pd.read_feather(path, columns=columns) for path in _sink_paths(directory, name)],
+                      ignore_index=True)
+    if name == 'offer_df':
+        table = apply_schema(table, OFFER_SCHEMA)
+        return add_offer_type_dummies(table) if columns is None else table
+    table = apply_schema(table, PROFILE_EXPANDED_SCHEMA)
+    return add_gender_dummies(table) if columns is None else table
+
+
+def user_partitions(users, n_partitions):
+    """
+    Returns the partition of every user id, a stable hash of the id modulo n_partitions
+    """
+    hashes = pd.util.hash_array(np.asarray(users, dtype=object))
+    return (hashes % np.uint64(n_partitions)).astype(np.int64)
+
+
+def _sink_paths(directory, name):
+    sink = os.path.join(directory, name)
+    return [os.path.join(sink, entry) for entry in sorted(os.listdir(sink)) if entry.endswith('.feather')]
+
+
+def _remove(path):
+    """
+    Removes a file or a directory tree if it exists
+    """
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    elif os.path.exists(path):
+        os.remove(path)
+
+
+def _write_feather(df, path):
+    """
+    Writes an uncompressed feather file under a temporary name and renames it
+    """
+    from pyarrow import feather
+
+    feather.write_feather(df, path + '.tmp', compression='uncompressed')
+    os.replace(path + '.tmp', path)
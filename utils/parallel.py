@@ -0,0 +1,121 @@
+import logging
+import os
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from utils.build_matrices import (add_offer_type_dummies, build_offer_df, build_offer_rows, build_user_df,
+                                  group_transcript_by_user)
+from utils.instrumentation import annotate, instrumented, latency_histogram
+from utils.lazy import lazy_import
+from utils.schema import OFFER_SCHEMA, PROFILE_EXPANDED_SCHEMA, apply_schema
+
+pd = lazy_import('pandas')
+
+logger = logging.getLogger(__name__)
+
+
+@instrumented('build_matrices_parallel', rows_arg=2)
+def build_matrices_parallel(portfolio, profile, transcript, n_workers=None, n_chunks=None):
+    """
+    Builds offer_df and profile_expanded in a process pool, partitioned by user.
+    The transcript is grouped by user and written once as memory-mapped arrays. Every worker maps the arrays and
+    builds the matrices of one contiguous chunk of users, the chunks are concatenated in user order so the result is
+    identical to build_offer_df and build_user_df. When instrumentation is on, the record holds
+    chunk_seconds_per_user, a histogram of the build time of every chunk divided by its number of users. The users of
+    a chunk are built together, so this is the average time per user of each chunk, not a per-user latency.
+    :param portfolio: cleaned portfolio dataframe
+    :param profile: cleaned profile dataframe
+    :param transcript: cleaned transcript dataframe
+    :param n_workers: number of worker processes, defaults to the number of CPUs. 1 runs the serial builders.
+    :param n_chunks: number of user chunks, defaults to four per worker
+    :return: (offer_df, profile_expanded)
+    """
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_workers == 1:
+        offer_df = build_offer_df(portfolio, profile, transcript)
+        return offer_df, build_user_df(portfolio, profile, transcript, offer_df)
+    if n_chunks is None:
+        n_chunks = 4 * n_workers
+
+    users = profile['id'].unique()
+    max_time = transcript.loc[:, 'time'].max()
+    user_transcripts, offsets = group_transcript_by_user(transcript, users)
+    # chunk boundaries balance the number of events rather than the number of users
+    bounds = np.searchsorted(offsets, np.linspace(0, offsets[-1], n_chunks + 1))
+    bounds[0], bounds[-1] = 0, len(users)
+    bounds = np.unique(bounds)
+
+    # memory-mapped files rather than multiprocessing.shared_memory: they are removed with the directory even when a
+    # worker dies, and the workers only need their paths
+    with tempfile.TemporaryDirectory() as directory:
+        columns = _write_columns(user_transcripts, directory)
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = [executor.submit(_build_chunk, portfolio, profile.loc[profile['id'].isin(users[lo:hi])],
+                                       users[lo:hi], offsets[lo:hi + 1], columns, max_time)
+                       for lo, hi in zip(bounds[:-1], bounds[1:])]
+            results = [future.result() for future in futures]
+
+    # the chunks have their own categories, they are unified by applying the schema again
+    offer_df = apply_schema(pd.concat([offer_rows for offer_rows, count, expanded, seconds in results]), OFFER_SCHEMA)
+    offer_df.index = pd.Index(np.arange(len(offer_df)))
+    offer_df = add_offer_type_dummies(offer_df)
+    count_users_no_offer = sum(count for offer_rows, count, expanded, seconds in results)
+    logger.info("%d received no offer", count_users_no_offer)
+
+    chunk_seconds = np.array([seconds for offer_rows, count, expanded, seconds in results])
+    annotate(users_no_offer=count_users_no_offer, chunks=len(results),
+             chunk_seconds_per_user=latency_histogram(chunk_seconds / np.diff(bounds)))
+
+    profile_expanded = pd.concat([expanded for offer_rows, count, expanded, seconds in results])
+    profile_expanded = profile_expanded.sort_values('user_id').reset_index(drop=True)
+    return offer_df, apply_schema(profile_expanded, PROFILE_EXPANDED_SCHEMA)
+
+
+def _write_columns(user_transcripts, directory):
+    """
+    Writes the transcript columns used by the builders as .npy files, string columns as integer codes.
+    Returns a dict of column name to (path, categories), categories is None for numeric columns.
+    """
+    columns = {}
+    for column in ['event', 'time', 'offer_id', 'amount']:
+        values = user_transcripts[column]
+        categories = None
+        if column in ['event', 'offer_id']:
+            codes, categories = pd.factorize(values)
+            values = codes
+            categories = np.asarray(categories, dtype=object)
+        path = os.path.join(directory, column + '.npy')
+        np.save(path, np.asarray(values))
+        columns[column] = (path, categories)
+    return columns
+
+
+def _read_columns(columns, start, stop):
+    """
+    Maps the columns written by _write_columns and decodes the rows start:stop
+    """
+    data = {}
+    for column, (path, categories) in columns.items():
+        values = np.load(path, mmap_mode='r')[start:stop]
+        if categories is not None:
+            values = pd.Categorical.from_codes(values, categories=categories).astype(object)
+        data[column] = np.asarray(values)
+    return data
+
+
+def _build_chunk(portfolio, profile, users, user_offsets, columns, max_time):
+    """
+    Builds the offer rows and the expanded profile of one chunk of users in a worker process.
+    The events of users[k] are the rows user_offsets[k]:user_offsets[k + 1] of the memory-mapped columns.
+    :return: (offer rows, number of users that received no offer, expanded profile, seconds taken)
+    """
+    start = time.perf_counter()
+    user_transcript = pd.DataFrame(_read_columns(columns, user_offsets[0], user_offsets[-1]))
+    user_transcript['id'] = np.repeat(users, np.diff(user_offsets))
+    offer_rows, count_users_no_offer = build_offer_rows(portfolio, profile, user_transcript)
+    expanded = build_user_df(portfolio, profile, user_transcript, offer_rows, max_time=max_time)
+    return offer_rows, count_users_no_offer, expanded, time.perf_counter() - start
@@ -0,0 +1,147 @@
+"""
+Lazy, memoised pipeline of the data preparation stages.
+
+Every stage is a node with a function, the names of the nodes it takes as inputs and a version. The fingerprint of a
+node hashes its name, its version, the content of the files it reads and the fingerprints of its inputs, so
+changing an input file or the source of a stage changes the fingerprint of that node and of everything downstream of
+it, and nothing else. Results are memoised in memory by fingerprint.
+
+The nodes of default_pipeline() after raw read their tables from the feather cache of utils.cache, which is the one
+on-disk store of the built tables, so a result built by the pipeline is reused by load_cached() and the other way
+round:
+
+    pipeline = default_pipeline(data_dir='data')
+    offer_df = pipeline.get('offer_df')
+
+The same pipeline runs headless with
+
+    python -m utils.pipeline offer_df profile_expanded --data-dir data --export .
+"""
+import argparse
+import hashlib
+import logging
+import os
+import pickle
+from collections import namedtuple
+
+from utils.cache import INPUT_FILES, hash_file, load_cached, source_modules
+from utils.loading import load_all
+
+logger = logging.getLogger(__name__)
+
+# func is called with the values of inputs, files are hashed into the fingerprint of the node
+Node = namedtuple('Node', ['name', 'func', 'inputs', 'version', 'files'])
+
+
+class Pipeline(object):
+    """
+    A DAG of nodes evaluated lazily on request
+    """
+
+    def __init__(self):
+        self.nodes = {}
+        self._memory = {}
+
+    def add(self, name, func, inputs=(), version='', files=()):
+        """
+        Adds a node, its inputs must already be part of the pipeline
+        :param name: name of the node
+        :param func: function called with the values of inputs
+        :param inputs: names of the input nodes
+        :param version: version of func, change it or use source_version() to recompute the node when func changes
+        :param files: paths of the files func reads, their content is part of the fingerprint
+        """
+        missing = [node for node in inputs if node not in self.nodes]
+        if missing:
+            raise ValueError("unknown inputs {} of {}".format(missing, name))
+        self.nodes[name] = Node(name, func, tuple(inputs), version, tuple(files))
+        return self
+
+    def fingerprint(self, name):
+        """
+        Returns the fingerprint of a node, computed from its definition without evaluating anything
+        """
+        node = self.nodes[name]
+        digest = hashlib.sha256('{}\0{}'.format(node.name, node.version).encode())
+        for path in node.files:
+            digest.update(hash_file(path).encode())
+        for input_name in node.inputs:
+            digest.update(self.fingerprint(input_name).encode())
+        return digest.hexdigest()[:16]
+
+    def get(self, name):
+        """
+        Returns the value of a node, from memory or by evaluating it and its inputs
+        """
+        node = self.nodes[name]
+        fingerprint = self.fingerprint(name)
+        if name in self._memory and self._memory[name][0] == fingerprint:
+            return self._memory[name][1]
+        logger.info("computing %s", name)
+        value = node.func(*[self.get(input_name) for input_name in node.inputs])
+        self._memory[name] = (fingerprint, value)
+        return value
+
+    def stale(self):
+        """
+        Returns the names of the nodes which would be evaluated by get() rather than taken from memory
+        """
+        return [name for name in self.nodes
+                if not (name in self._memory and self._memory[name][0] == self.fingerprint(name))]
+
+
+def source_version(*modules):
+    """
+    Returns a hash of the source of the modules and of the utils modules they import, e.g. source_version('cleaning.py')
+    for utils/cleaning.py, see utils.cache.source_modules
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    return hashlib.sha256(''.join(hash_file(os.path.join(directory, module))
+                                  for module in source_modules(*modules)).encode()).hexdigest()[:16]
+
+
+def default_pipeline(data_dir='data', cache_dir='cache'):
+    """
+    Returns the pipeline of the notebooks: raw, clean, offer_df and profile_expanded.
+    raw and clean are (portfolio, profile, transcript) tuples. clean, offer_df and profile_expanded are read with
+    load_cached() from cache_dir, which builds the missing tables, they are versioned with the sources of the cache.
+    """
+    files = [os.path.join(data_dir, name) for name in INPUT_FILES]
+    cache_version = source_version('cache.py')
+
+    def cached(*names):
+        tables = [load_cached(name, data_dir=data_dir, cache_dir=cache_dir) for name in names]
+        return tuple(tables) if len(tables) > 1 else tables[0]
+
+    pipeline = Pipeline()
+    pipeline.add('raw', lambda: load_all(data_dir), version=source_version('loading.py'), files=files)
+    pipeline.add('clean', lambda: cached('portfolio', 'profile', 'transcript'), version=cache_version, files=files)
+    pipeline.add('offer_df', lambda: cached('offer_df'), version=cache_version, files=files)
+    pipeline.add('profile_expanded', lambda: cached('profile_expanded'), version=cache_version, files=files)
+    return pipeline
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Evaluates nodes of the data preparation pipeline')
+    parser.add_argument('nodes', nargs='*', default=['offer_df', 'profile_expanded'],
+                        help='nodes to evaluate, offer_df and profile_expanded by default')
+    parser.add_argument('--data-dir', default='data')
+    parser.add_argument('--cache-dir', default='cache', help='directory of the feather cache of utils.cache')
+    parser.add_argument('--export', default=None, help='directory to write <node>.pkl of every evaluated node to')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(name)s %(message)s')
+    pipeline = default_pipeline(args.data_dir, args.cache_dir)
+    unknown = [name for name in args.nodes if name not in pipeline.nodes]
+    if unknown:
+        parser.error("unknown nodes {}, expected some of {}".format(unknown, list(pipeline.nodes)))
+    for name in args.nodes:
+        value = pipeline.get(name)
+        if args.export:
+            os.makedirs(args.export, exist_ok=True)
+            with open(os.path.join(args.export, name + '.pkl'), 'wb') as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,17 @@
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
-import pandas as pd
-import matplotlib.pyplot as plt
 
-from matplotlib.patches import Rectangle
-from matplotlib.collections import PatchCollection
-from matplotlib.lines import Line2D
+from utils.build_matrices import (_offer_groups, as_offer_table, group_transcript_by_user, lookup_offer_codes,
+                                  match_offer_events)
+from utils.lazy import lazy_import
+
+pd = lazy_import('pandas')
+logger = logging.getLogger(__name__)
+
+MARKER_SIZE = 15
 
 
 def simple_offer_plot(user, portfolio, profile, transcript, ax):
@@ -16,17 +23,18 @@ def simple_offer_plot(user, portfolio, profile, transcript, ax):
     :param transcript: cleaned transcript dataframe
     :return: ax object
     """
+    import matplotlib.pyplot as plt
+    from matplotlib.collections import PatchCollection
+    from matplotlib.patches import Rectangle
 
     user_transcript = transcript.loc[transcript['id'] == user, :]
     # get all offer data
+    offer_table = as_offer_table(portfolio)
+    offer_codes = lookup_offer_codes(offer_table,
+                                     user_transcript.loc[user_transcript['event'] == 'offer received', 'offer_id'])
     offers_start = np.array(user_transcript.loc[user_transcript['event'] == 'offer received', 'time'])
-    offer_duration = np.array(
-        [portfolio.loc[portfolio['id'] == offer_id, 'duration'].values.astype(int)[0] * 24 for offer_id in
-         user_transcript.loc[user_transcript['event'] == 'offer received', 'offer_id']])
-    offer_reward = np.array(
-        [portfolio.loc[portfolio['id'] == offer_id, 'reward'].values.astype(int)[0] * 2 + 1 for offer_id in
-         user_transcript.loc[user_transcript[
-                                  'event'] == 'offer received', 'offer_id']])  # times 2 and +1 to avoid having boxes with 0 height
+    offer_duration = offer_table.duration[offer_codes]
+    offer_reward = offer_table.reward[offer_codes] * 2 + 1  # times 2 and +1 to avoid having boxes with 0 height
 
     offers_end = np.array(user_transcript.loc[user_transcript['event'] == 'offer received', 'time']) + offer_duration
     offers_viewed = np.array(user_transcript.loc[user_transcript['event'] == 'offer viewed', 'time'])
@@ -48,6 +56,10 @@ def simple_offer_plot(user, portfolio, profile, transcript, ax):
     return ax
 
 def detailed_offer_plot(user, portfolio, profile, transcript):
+    import matplotlib.pyplot as plt
+    from matplotlib.lines import Line2D
+    from matplotlib.patches import Rectangle
+
     # get user related data
     user_transcript = transcript.loc[transcript['id'] == user, :]
     user_profile = profile.loc[profile['id'] == user, :]
@@ -63,19 +75,13 @@ def detailed_offer_plot(user, portfolio, profile, transcript):
     offer_ids = [(i, offer_id) for i, offer_id in
                  enumerate(user_transcript.loc[user_transcript['event'] == 'offer received', 'offer_id'])]
     offers_start = np.array(user_transcript.loc[user_transcript['event'] == 'offer received', 'time'])
-    offers_type = np.array(
-        [portfolio.loc[portfolio['id'] == offer_id, 'offer_type'].values.astype(str)[0] for offer_id in
-         user_transcript.loc[user_transcript['event'] == 'offer received', 'offer_id']])
-    offers_difficulty = np.array(
-        [portfolio.loc[portfolio['id'] == offer_id, 'difficulty'].values.astype(str)[0] for offer_id in
-         user_transcript.loc[user_transcript['event'] == 'offer received', 'offer_id']])
-    offers_reward = np.array(
-        [portfolio.loc[portfolio['id'] == offer_id, 'reward'].values.astype(str)[0] for offer_id in
-         user_transcript.loc[user_transcript['event'] == 'offer received', 'offer_id']])
+    offer_table = as_offer_table(portfolio)
+    offer_codes = lookup_offer_codes(offer_table, [offer_id for i, offer_id in offer_ids])
+    offers_type = offer_table.types[offer_table.type_codes[offer_codes]]
+    offers_difficulty = offer_table.difficulty[offer_codes]
+    offers_reward = offer_table.reward[offer_codes]
     n_offers = len(offers_start)
-    offers_duration = np.array(
-        [portfolio.loc[portfolio['id'] == offer_id, 'duration'].values.astype(int)[0] * 24 for offer_id in
-         user_transcript.loc[user_transcript['event'] == 'offer received', 'offer_id']])
+    offers_duration = offer_table.duration[offer_codes]
     offers_end = np.array(user_transcript.loc[user_transcript['event'] == 'offer received', 'time']) + offers_duration
     offers_viewed = np.array(user_transcript.loc[user_transcript['event'] == 'offer viewed', ['time', 'offer_id']])
     offers_completed = np.array(
@@ -171,4 +177,176 @@ def detailed_offer_plot(user, portfolio, profile, transcript):
     return fig
 
 
+def gantt_plots(users, transcript, offer_df, directory='plots/gantt_plots', n_workers=None, dpi=100):
+    """
+    Renders the Gantt plot of every user to <directory>/<user id>.png.
+    The offers, views and completions are taken from offer_df and the transcript is grouped by user once for all
+    users, see gantt_data(). The figures are drawn with collections on the Agg canvas in a process pool.
+    :param users: list of user ids
+    :param transcript: cleaned transcript dataframe
+    :param offer_df: offer matrix built by build_offer_df
+    :param directory: directory of the png files
+    :param n_workers: number of worker processes, defaults to the number of CPUs. 1 renders in this process.
+    :param dpi: resolution of the png files
+    :return: list of the paths written
+    """
+    os.makedirs(directory, exist_ok=True)
+    data = gantt_data(users, transcript, offer_df)
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_workers == 1 or len(data) < 2:
+        return _render_chunk(data, directory, dpi)
+    chunk_size = -(-len(data) // (4 * n_workers))
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        futures = [executor.submit(_render_chunk, data[start:start + chunk_size], directory, dpi)
+                   for start in range(0, len(data), chunk_size)]
+        return [path for future in futures for path in future.result()]
+
 
+def gantt_data(users, transcript, offer_df):
+    """
+    Collects the arrays drawn by gantt_figure() for every user.
+    Users that are neither in the transcript nor in offer_df are left out and logged.
+    Views after the completion are not part of offer_df, they are matched for all offers at once in the full offer
+    window so they can be marked as viewed after completion.
+    :return: list of dicts with the user id, the offer columns of offer_df and late_view_time, and the transaction
+        times and amounts
+    """
+    users = pd.Index(pd.unique(np.asarray(users, dtype=object)))
+    known = users.isin(np.asarray(transcript['id'], dtype=object)) | \
+        users.isin(np.asarray(offer_df['user_id'], dtype=object))
+    if not known.all():
+        logger.warning("%d users are not in the transcript or offer_df and are not plotted: %s", (~known).sum(),
+                       ', '.join(map(str, users[~known])))
+    users = np.asarray(users[known], dtype=object)
+    offers, offer_offsets = group_transcript_by_user(offer_df, users, column='user_id')
+    user_transcripts, offsets = group_transcript_by_user(transcript, users)
+    events = np.asarray(user_transcripts['event'])
+    times = np.asarray(user_transcripts['time'])
+    amounts = np.asarray(user_transcripts['amount'], dtype=float)
+    event_users = np.repeat(np.arange(len(users)), np.diff(offsets))
+    offer_users = np.repeat(np.arange(len(users)), np.diff(offer_offsets))
+
+    starts = np.asarray(offers['start_time'])
+    ends = np.asarray(offers['end_time'])
+    is_view = events == 'offer viewed'
+    groups = _offer_groups(np.concatenate((offer_users, event_users[is_view])),
+                           np.concatenate((np.asarray(offers['offer_id'], dtype=object),
+                                           np.asarray(user_transcripts['offer_id'], dtype=object)[is_view])))
+    late_view = match_offer_events(groups[:len(offers)], starts, ends, groups[len(offers):], times[is_view])
+    late_view_time = np.append(times[is_view], np.nan)[late_view]
+    late_view_time[~np.isnan(offers['view_time'].to_numpy(dtype=float, na_value=np.nan))] = np.nan
+
+    columns = {'offer_type': np.asarray(offers['offer_type'], dtype=object),
+               'difficulty': np.asarray(offers['difficulty']),
+               'reward': np.asarray(offers['reward']),
+               'start_time': starts,
+               'end_time': ends,
+               'view_time': offers['view_time'].to_numpy(dtype=float, na_value=np.nan),
+               'complet_time': offers['complet_time'].to_numpy(dtype=float, na_value=np.nan),
+               'late_view_time': late_view_time}
+    is_transaction = events == 'transaction'
+    transaction_offsets = np.searchsorted(event_users[is_transaction], np.arange(len(users) + 1))
+    transaction_times = times[is_transaction]
+    transaction_amounts = amounts[is_transaction]
+
+    data = []
+    for k, user in enumerate(users):
+        lo, hi = offer_offsets[k], offer_offsets[k + 1]
+        t_lo, t_hi = transaction_offsets[k], transaction_offsets[k + 1]
+        item = {name: values[lo:hi] for name, values in columns.items()}
+        item.update(user=user, transaction_time=transaction_times[t_lo:t_hi],
+                    transaction_amount=transaction_amounts[t_lo:t_hi])
+        data.append(item)
+    return data
+
+
+def gantt_figure(item):
+    """
+    Draws the Gantt plot of one gantt_data() item: one row per offer with its window, start, end, view and completion
+    and the transactions during the window, and the cumulative spending below.
+    The offer windows, transactions and markers are each drawn as a single collection.
+    :return: matplotlib Figure attached to an Agg canvas
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.collections import LineCollection, PatchCollection
+    from matplotlib.figure import Figure
+    from matplotlib.lines import Line2D
+    from matplotlib.patches import Rectangle
+
+    n_offers = len(item['start_time'])
+    fig = Figure(figsize=(12, 2 + 0.6 * max(n_offers, 1)))
+    FigureCanvasAgg(fig)
+    ax, ax_spent = fig.subplots(2, 1, sharex=True, gridspec_kw={'height_ratios': [max(n_offers, 1), 2]})
+    rows = np.arange(n_offers)
+
+    windows = [Rectangle((start, row - 0.4), end - start, 0.8)
+               for row, start, end in zip(rows, item['start_time'], item['end_time'])]
+    ax.add_collection(PatchCollection(windows, facecolor='silver', alpha=0.5, edgecolor='k', linewidth=2))
+
+    # transactions during an offer window as bars from the bottom of the offer row, scaled by the largest amount
+    times, amounts = item['transaction_time'], item['transaction_amount']
+    order = np.argsort(times, kind='stable')
+    times, amounts = times[order], amounts[order]
+    lo = np.searchsorted(times, item['start_time'], side='left')
+    hi = np.searchsorted(times, item['end_time'], side='right')
+    segment_rows = np.repeat(rows, hi - lo)
+    segment_index = np.concatenate([np.arange(a, b) for a, b in zip(lo, hi)] + [np.array([], dtype=int)])
+    if len(segment_index):
+        # transactions of 0 USD are drawn without height
+        heights = amounts[segment_index] / (amounts.max() if amounts.max() > 0 else 1) * 0.8
+        x = times[segment_index]
+        segments = np.stack([np.column_stack((x, segment_rows + 0.4)),
+                             np.column_stack((x, segment_rows + 0.4 - heights))], axis=1)
+        ax.add_collection(LineCollection(segments, colors='k', linewidths=3))
+
+    view_time, complet_time = item['view_time'], item['complet_time']
+    late = ~np.isnan(item['late_view_time'])
+    markers = [(item['start_time'], rows, 'g', 5),
+               (item['end_time'], rows, 'r', 4),
+               (view_time, rows, 'y', 'd'),
+               (item['late_view_time'][late], rows[late], 'maroon', 'd'),
+               (complet_time, rows, 'b', '*')]
+    for x, y, color, marker in markers:
+        ax.scatter(x, y, c=color, marker=marker, s=MARKER_SIZE ** 2, zorder=3)
+
+    ax.set_yticks(rows)
+    ax.set_yticklabels(['{} {}/{}'.format(offer_type, difficulty, reward) for offer_type, difficulty, reward in
+                        zip(item['offer_type'], item['difficulty'], item['reward'])], fontsize=8)
+    ax.set_ylim(max(n_offers, 1) - 0.5, -0.5)
+    ax.set_xlim((-20, 750))
+    ax.set_title('user {}, offer type difficulty/reward per row'.format(item['user']), fontsize=10)
+
+    spent = np.cumsum(amounts)
+    ax_spent.step(np.concatenate(([0], times)), np.concatenate(([0], spent)), 'b', where='post')
+    ax_spent.set_xlabel('Time [h]')
+    ax_spent.set_ylabel('USD')
+    ax_spent.grid(True)
+
+    legend_elements = [Line2D([0], [0], color='g', marker=5, linewidth=0, markersize=MARKER_SIZE, label='offer start'),
+                       Line2D([0], [0], color='r', marker=4, linewidth=0, markersize=MARKER_SIZE, label='offer end'),
+                       Line2D([0], [0], color='y', marker='d', linewidth=0, markersize=MARKER_SIZE,
+                              label='viewed offer'),
+                       Line2D([0], [0], color='b', marker='*', linewidth=0, markersize=MARKER_SIZE,
+                              label='completed offer'),
+                       Line2D([0], [0], color='maroon', marker='d', linewidth=0, markersize=MARKER_SIZE,
+                              label='viewed after completion'),
+                       Line2D([0], [0], color='k', marker='|', linewidth=0, markersize=MARKER_SIZE,
+                              label='transaction'),
+                       Line2D([0], [0], color='b', linewidth=1, label='cumulative spending [USD]')]
+    fig.legend(handles=legend_elements, loc='upper center', ncol=len(legend_elements), fontsize=8)
+    # margins in inches, room for the legend above and the x label below
+    fig.subplots_adjust(top=1 - 0.9 / fig.get_figheight(), bottom=0.7 / fig.get_figheight(), hspace=0.1)
+    return fig
+
+
+def _render_chunk(data, directory, dpi):
+    """
+    Renders and saves the Gantt plots of a list of gantt_data() items
+    """
+    paths = []
+    for item in data:
+        path = os.path.join(directory, '{}.png'.format(item['user']))
+        gantt_figure(item).savefig(path, dpi=dpi)
+        paths.append(path)
+    return paths
@@ -0,0 +1,133 @@
+"""
+Column types of the built matrices.
+
+Ids and offer types are categoricals, hours are int16, view and completion times are nullable Int16 (<NA> when the
+offer was not viewed or completed), flags are int8 and amounts float32. The builders emit these types and the cache
+validates the tables it reads against them.
+"""
+import numpy as np
+
+from utils.lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+OFFER_SCHEMA = {'offer_id': 'category',
+                'user_id': 'category',
+                'offer_type': 'category',
+                'difficulty': 'int16',
+                'reward': 'int16',
+                'start_time': 'int16',
+                'duration': 'int16',
+                'end_time': 'int16',
+                'viewed': 'int8',
+                'view_time': 'Int16',
+                'completed': 'int8',
+                'complet_time': 'Int16',
+                'time_in_window': 'int16',
+                'amount_in_window': 'float32'}
+# prefix of the offer type dummies added by add_offer_type_dummies
+OFFER_DUMMIES = 'type_'
+
+PROFILE_EXPANDED_SCHEMA = {'gender': 'category',
+                           'age': 'int16',
+                           'income': 'float32',
+                           'user_id': 'category',
+                           'spent_total': 'float32',
+                           'spent_in_window': 'float32',
+                           'spent_no_window': 'float32',
+                           'spent_in_discount': 'float32',
+                           'spent_in_bogo': 'float32',
+                           'spent_in_informational': 'float32',
+                           'time_in_window': 'int16',
+                           'time_no_window': 'int16',
+                           'time_in_discount': 'int16',
+                           'time_in_bogo': 'int16',
+                           'time_in_informational': 'int16',
+                           'view_ratio': 'float32',
+                           'completion_ratio': 'float32',
+                           'view_and_complete_ratio': 'float32',
+                           'num_offers_received': 'int16'}
+# prefix of the gender dummies added by add_gender_dummies
+PROFILE_EXPANDED_DUMMIES = 'gender_'
+
+
+def apply_schema(df, schema, dummies=None):
+    """
+    Casts the columns of df to the types of schema, columns not in the schema are kept as they are.
+    Categoricals get sorted categories without unused ones, so tables built in parts and concatenated get the same
+    categories as tables built at once.
+    :param df: dataframe
+    :param schema: dict of column name to dtype
+    :param dummies: prefix of dummy columns which are cast to bool
+    :return: pd.DataFrame
+    :raises ValueError: if integer values do not fit the integer type of their column
+    """
+    df = df.copy(deep=False)
+    for column, dtype in schema.items():
+        if column not in df.columns:
+            continue
+        if dtype == 'category':
+            df[column] = _as_category(df[column])
+            continue
+        if dtype.lower().startswith('int'):
+            _check_range(df[column], column, dtype)
+        df[column] = df[column].astype(dtype)
+    if dummies:
+        for column in df.columns:
+            if str(column).startswith(dummies):
+                df[column] = df[column].astype(bool)
+    return df
+
+
+def validate(df, schema, dummies=None, partial=False):
+    """
+    Checks that the columns of df have the types of schema
+    :param df: dataframe
+    :param schema: dict of column name to dtype
+    :param dummies: prefix of dummy columns which must be bool
+    :param partial: if True, missing columns are allowed, e.g. when only some columns were read
+    :return: df
+    :raises ValueError: listing the missing columns and the columns of the wrong type
+    """
+    problems = []
+    for column, dtype in schema.items():
+        if column not in df.columns:
+            if not partial:
+                problems.append('{} is missing'.format(column))
+        elif not _has_dtype(df[column], dtype):
+            problems.append('{} is {}, expected {}'.format(column, df[column].dtype, dtype))
+    if dummies:
+        problems.extend('{} is {}, expected bool'.format(column, df[column].dtype) for column in df.columns
+                        if str(column).startswith(dummies) and df[column].dtype != bool)
+    if problems:
+        raise ValueError('table does not match the schema: ' + '; '.join(problems))
+    return df
+
+
+def _as_category(values):
+    """
+    Returns values as a categorical with sorted categories and no unused categories
+    """
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        values = values.cat.remove_unused_categories()
+        return values.cat.reorder_categories(values.cat.categories.sort_values())
+    return values.astype('category')
+
+
+def _has_dtype(values, dtype):
+    """
+    Returns True if values have the dtype named in a schema
+    """
+    if dtype == 'category':
+        return isinstance(values.dtype, pd.CategoricalDtype)
+    return values.dtype == pd.api.types.pandas_dtype(dtype)
+
+
+def _check_range(values, column, dtype):
+    """
+    Raises ValueError if values do not fit the integer dtype, astype would silently wrap them around
+    """
+    info = np.iinfo(dtype.lower())
+    lowest, highest = values.min(), values.max()
+    if pd.notna(lowest) and (lowest < info.min or highest > info.max):
+        raise ValueError('{} has values in [{}, {}] which do not fit {}'.format(column, lowest, highest, dtype))
@@ -0,0 +1,162 @@
+"""
+Demographic buckets and a reusable group index for segment level aggregations.
+
+clean_profile_data(profile, buckets=True) adds the age_bucket, income_bucket and member_cohort columns once, and they
+are carried into profile_expanded by build_user_df. A group index holds the group code of every row and the rows
+sorted by group, so any number of metrics are then aggregated per segment with np.bincount or ufunc.reduceat instead
+of a groupby per metric:
+
+    index = group_index(profile_expanded, ['gender', 'income_bucket'])
+    aggregate(index, profile_expanded, ['spent_in_window', 'spent_no_window'], how='mean')
+"""
+from collections import namedtuple
+
+import numpy as np
+
+from utils.lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+# 118 is the age of the default profiles, it is outside the bins and bucketed as unknown
+AGE_BINS = [17, 24, 34, 44, 54, 64, 74, 84, 117]
+AGE_LABELS = ['18-24', '25-34', '35-44', '45-54', '55-64', '65-74', '75-84', '85+']
+INCOME_BINS = [0, 40000, 60000, 80000, 100000, np.inf]
+INCOME_LABELS = ['<40k', '40-60k', '60-80k', '80-100k', '100k+']
+UNKNOWN = 'unknown'
+# quarters of the membership start, as pd.Grouper(freq='Q') on became_member_on
+COHORT_FREQ = 'Q'
+
+# keys: one row per group with the values of the group columns, codes: group of every row (-1 for rows with a
+# missing key), order: rows sorted by group, offsets: the rows of group k are order[offsets[k]:offsets[k + 1]]
+GroupIndex = namedtuple('GroupIndex', ['keys', 'codes', 'order', 'offsets'])
+
+AGGREGATIONS = ['count', 'sum', 'mean', 'min', 'max']
+
+
+def add_buckets(profile):
+    """
+    Adds the age_bucket and income_bucket categoricals, with unknown for default profiles, and the member_cohort
+    quarter of became_member_on
+    :param profile: profile dataframe with became_member_on as datetime
+    :return: pd.DataFrame
+    """
+    profile = profile.copy()
+    profile['age_bucket'] = age_buckets(profile['age'])
+    profile['income_bucket'] = income_buckets(profile['income'])
+    profile['member_cohort'] = member_cohorts(profile['became_member_on'])
+    return profile
+
+
+def age_buckets(age):
+    """
+    Returns the age bucket of every age as an ordered categorical, unknown outside AGE_BINS
+    """
+    buckets = pd.cut(np.asarray(age, dtype=float), bins=AGE_BINS, labels=AGE_LABELS)
+    return _with_unknown(buckets)
+
+
+def income_buckets(income):
+    """
+    Returns the income bucket of every income as an ordered categorical, unknown for a missing income
+    """
+    buckets = pd.cut(np.asarray(income, dtype=float), bins=INCOME_BINS, labels=INCOME_LABELS, right=False)
+    return _with_unknown(buckets)
+
+
+def member_cohorts(became_member_on):
+    """
+    Returns the quarter of every membership start as a period array
+    """
+    return pd.PeriodIndex(pd.DatetimeIndex(became_member_on), freq=COHORT_FREQ).array
+
+
+def group_index(df, by, dropna=True):
+    """
+    Builds the group index of the columns by.
+    Groups are sorted by their keys, in category order for categorical columns, and only groups with rows are kept.
+    :param df: dataframe
+    :param by: list of column names
+    :param dropna: if True, rows with a missing value in a key column are in no group, as in DataFrame.groupby
+    :return: GroupIndex
+    """
+    by = list(by)
+    combined = np.zeros(len(df), dtype=np.int64)
+    missing = np.zeros(len(df), dtype=bool)
+    columns = []
+    for column in by:
+        values = df[column]
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            codes, size = np.asarray(values.cat.codes, dtype=np.int64), len(values.cat.categories)
+            uniques = values.dtype
+        else:
+            codes, uniques = pd.factorize(values, sort=True, use_na_sentinel=dropna)
+            codes, size = codes.astype(np.int64), len(uniques)
+        if dropna:
+            missing |= codes < 0
+        # missing values sort after all values, as groupby(dropna=False) orders them
+        combined = combined * (size + 1) + np.where(codes < 0, size, codes)
+        columns.append((column, uniques, size))
+
+    keys, codes = np.unique(combined[~missing], return_inverse=True)
+    all_codes = np.full(len(df), -1, dtype=np.int64)
+    all_codes[~missing] = codes.reshape(-1)
+    key_columns = {}
+    for column, uniques, size in reversed(columns):
+        key_codes = keys % (size + 1)
+        key_codes = np.where(key_codes == size, -1, key_codes)
+        # keys keep the dtype of their column, categoricals with all their categories
+        if isinstance(uniques, pd.CategoricalDtype):
+            key_columns[column] = pd.Categorical.from_codes(key_codes, dtype=uniques)
+        else:
+            key_columns[column] = uniques.take(key_codes, allow_fill=True, fill_value=np.nan)
+        keys = keys // (size + 1)
+    key_frame = pd.DataFrame({column: key_columns[column] for column in by})
+
+    order = np.argsort(all_codes, kind='stable')
+    order = order[all_codes[order] >= 0]
+    offsets = np.searchsorted(all_codes[order], np.arange(len(key_frame) + 1))
+    return GroupIndex(key_frame, all_codes, order, offsets)
+
+
+def aggregate(index, df, columns, how='mean'):
+    """
+    Aggregates columns of df per group of the index, missing values are skipped as in DataFrame.groupby
+    :param index: GroupIndex of df
+    :param columns: list of numeric column names
+    :param how: one of AGGREGATIONS
+    :return: pd.DataFrame with one row per group, indexed by the group keys
+    """
+    if how not in AGGREGATIONS:
+        raise ValueError("unknown aggregation {}, expected one of {}".format(how, AGGREGATIONS))
+    n_groups = len(index.keys)
+    grouped = index.codes >= 0
+    result = {}
+    for column in columns:
+        values = np.asarray(df[column], dtype=float)
+        valid = grouped & ~np.isnan(values)
+        if how in ('min', 'max'):
+            sorted_values = values[index.order]
+            starts = index.offsets[:-1]
+            reduce = np.fmin if how == 'min' else np.fmax
+            result[column] = reduce.reduceat(sorted_values, starts) if len(sorted_values) else np.zeros(n_groups)
+            continue
+        count = np.bincount(index.codes[valid], minlength=n_groups)
+        if how == 'count':
+            result[column] = count
+            continue
+        total = np.bincount(index.codes[valid], weights=values[valid], minlength=n_groups)
+        if how == 'sum':
+            result[column] = total
+        else:
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result[column] = total / count
+    return pd.DataFrame(result, index=pd.MultiIndex.from_frame(index.keys) if index.keys.shape[1] > 1
+                        else pd.Index(index.keys.iloc[:, 0]))
+
+
+def _with_unknown(buckets):
+    """
+    Returns a categorical of the bucket labels and unknown, with unknown for values outside the bins
+    """
+    codes = np.where(buckets.codes < 0, len(buckets.categories), buckets.codes)
+    return pd.Categorical.from_codes(codes, categories=list(buckets.categories) + [UNKNOWN], ordered=True)
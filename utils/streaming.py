@@ -0,0 +1,251 @@
+"""
+Online offer state tracker, fed with transcript events as they arrive.
+
+Every received offer is tracked by (user, offer id, start) until its window can no longer change, then it is emitted
+as a finished offer_df row. The rules are those of build_offer_rows:
+- the completion is the first completion of the offer id in [start, end]
+- the view is the first view of the offer id in [start, end], and not after a completion (except a completion in hour 0)
+- time_in_window is window end - view time + 1, where the window ends at the completion or at the end of the offer
+- amount_in_window sums the transactions from the view time to the window end + 1 hour
+
+Events are expected in time order, as in the transcript. The events of one hour are buffered and applied together,
+receipts first, then completions, views and transactions, so the order of events within an hour does not matter.
+Replaying the historical transcript gives the batch offer_df:
+
+    offer_df = replay(portfolio, profile, transcript)
+
+and live events are consumed from an iterator or an asyncio queue:
+
+    tracker = OfferTracker(portfolio)
+    for row in track(events, tracker):
+        ...
+"""
+import heapq
+from collections import defaultdict, deque
+
+import numpy as np
+
+from utils.build_matrices import add_offer_type_dummies, as_offer_table
+from utils.lazy import lazy_import
+from utils.schema import OFFER_SCHEMA, apply_schema
+
+pd = lazy_import('pandas')
+
+# order in which the events of one hour are applied
+EVENT_ORDER = {'offer received': 0, 'offer completed': 1, 'offer viewed': 2, 'transaction': 3}
+
+
+class OfferTracker(object):
+    """
+    State of the open offers of all users
+    """
+
+    def __init__(self, portfolio):
+        """
+        :param portfolio: cleaned portfolio dataframe or OfferTable
+        """
+        self.offer_table = as_offer_table(portfolio)
+        self._offer_codes = {offer_id: code for code, offer_id in enumerate(self.offer_table.index)}
+        self.hour = None
+        self.n_received = 0
+        self._events = []
+        # open offers by (user, offer id) and by user, and a heap of (last hour affecting the offer, sequence)
+        self._offers = defaultdict(list)
+        self._user_offers = defaultdict(dict)
+        self._expiry = []
+        # transactions of users with open offers, as (time, amount) in arrival order
+        self._transactions = defaultdict(deque)
+
+    @property
+    def n_open(self):
+        """
+        Number of offers not emitted yet
+        """
+        return len(self._expiry)
+
+    def push(self, event):
+        """
+        Adds one event, a transcript record with id or person, event, time and the offer id and amount either as
+        columns or in the value dict of the raw transcript
+        :return: list of the offer rows finished by the event
+        """
+        return self.push_many([event])
+
+    def push_many(self, events):
+        """
+        Adds a micro-batch of events
+        :return: list of the offer rows finished by the events
+        """
+        rows = []
+        for event in events:
+            user, kind, time, offer_id, amount = _as_event(event)
+            if self.hour is not None and time < self.hour:
+                raise ValueError("event at hour {} after hour {}, events must arrive in time order".format(
+                    time, self.hour))
+            if self.hour is not None and time > self.hour:
+                rows.extend(self._apply_hour())
+            self.hour = time
+            self._events.append((EVENT_ORDER[kind], len(self._events), user, kind, time, offer_id, amount))
+        return rows
+
+    def flush(self):
+        """
+        Applies the buffered events and emits all open offers, for the end of a replay
+        :return: list of offer rows
+        """
+        rows = self._apply_hour()
+        while self._expiry:
+            rows.append(self._finish(*heapq.heappop(self._expiry)[1:]))
+        return rows
+
+    def _apply_hour(self):
+        """
+        Applies the buffered events of the current hour and emits the offers which can no longer change
+        """
+        for _, _, user, kind, time, offer_id, amount in sorted(self._events):
+            if kind == 'offer received':
+                self._receive(user, offer_id, time)
+            elif kind == 'offer completed':
+                for offer in self._offers.get((user, offer_id), ()):
+                    if not offer['completed'] and offer['start_time'] <= time <= offer['end_time']:
+                        offer['completed'], offer['complet_time'] = 1, time
+            elif kind == 'offer viewed':
+                for offer in self._offers.get((user, offer_id), ()):
+                    if not offer['viewed'] and offer['start_time'] <= time <= _view_limit(offer):
+                        offer['viewed'], offer['view_time'] = 1, time
+            elif user in self._user_offers:
+                self._transactions[user].append((time, amount))
+        self._events = []
+
+        rows = []
+        while self._expiry and self._expiry[0][0] <= self.hour:
+            rows.append(self._finish(*heapq.heappop(self._expiry)[1:]))
+        return rows
+
+    def _receive(self, user, offer_id, time):
+        if offer_id not in self._offer_codes:
+            raise KeyError("offer ids not in portfolio: {}".format([offer_id]))
+        code = self._offer_codes[offer_id]
+        table = self.offer_table
+        duration = int(table.duration[code])
+        offer = {'sequence': self.n_received, 'offer_id': offer_id, 'user_id': user,
+                 'offer_type': table.types[table.type_codes[code]], 'difficulty': int(table.difficulty[code]),
+                 'reward': int(table.reward[code]), 'start_time': time, 'duration': duration,
+                 'end_time': time + duration, 'viewed': 0, 'view_time': np.nan, 'completed': 0,
+                 'complet_time': np.nan}
+        self.n_received += 1
+        self._offers[(user, offer_id)].append(offer)
+        self._user_offers[user][offer['sequence']] = offer
+        # transactions up to one hour after the end of the window still count
+        heapq.heappush(self._expiry, (offer['end_time'] + 1, offer['sequence'], user))
+
+    def _finish(self, sequence, user):
+        """
+        Removes a tracked offer and returns its row
+        """
+        offer = self._user_offers[user].pop(sequence)
+        same_offers = self._offers[(user, offer['offer_id'])]
+        same_offers.remove(offer)
+        if not same_offers:
+            del self._offers[(user, offer['offer_id'])]
+
+        window_end = _window_end(offer)
+        if offer['viewed']:
+            offer['time_in_window'] = int(window_end - offer['view_time'] + 1)
+            amounts = [amount for time, amount in self._transactions[user]
+                       if offer['view_time'] <= time <= window_end + 1]
+            offer['amount_in_window'] = float(np.asarray(amounts).sum()) if amounts else 0.0
+        else:
+            offer['time_in_window'], offer['amount_in_window'] = 0, 0.0
+
+        # transactions before the earliest start of the remaining offers of the user can no longer count
+        if self._user_offers[user]:
+            earliest = min(remaining['start_time'] for remaining in self._user_offers[user].values())
+            transactions = self._transactions[user]
+            while transactions and transactions[0][0] < earliest:
+                transactions.popleft()
+        else:
+            del self._user_offers[user]
+            self._transactions.pop(user, None)
+        return offer
+
+
+def track(events, tracker):
+    """
+    Feeds an iterable of events, or of lists of events, to the tracker and yields the offer rows as they finish.
+    All open offers are emitted when the events are exhausted.
+    """
+    for event in events:
+        for row in (tracker.push_many(event) if isinstance(event, list) else tracker.push(event)):
+            yield row
+    for row in tracker.flush():
+        yield row
+
+
+async def track_queue(queue, tracker):
+    """
+    Like track(), for events or lists of events read from an asyncio.Queue. None ends the stream.
+    """
+    while True:
+        event = await queue.get()
+        if event is None:
+            break
+        for row in (tracker.push_many(event) if isinstance(event, list) else tracker.push(event)):
+            yield row
+    for row in tracker.flush():
+        yield row
+
+
+def replay(portfolio, profile, transcript):
+    """
+    Replays a cleaned transcript through an OfferTracker
+    :return: offer matrix in the order and types of build_offer_df
+    """
+    tracker = OfferTracker(portfolio)
+    columns = zip(np.asarray(transcript['id'], dtype=object), np.asarray(transcript['event'], dtype=object),
+                  np.asarray(transcript['time']).tolist(), np.asarray(transcript['offer_id'], dtype=object),
+                  np.asarray(transcript['amount']))
+    events = ({'id': user, 'event': kind, 'time': time, 'offer_id': offer_id, 'amount': amount}
+              for user, kind, time, offer_id, amount in columns)
+    return add_offer_type_dummies(offer_frame(list(track(events, tracker)), users=profile['id'].unique()))
+
+
+def offer_frame(rows, users=None):
+    """
+    Returns tracker rows as an offer matrix without the offer type dummies, in the types of utils.schema
+    :param users: if given, only the offers of these users are kept, ordered like build_offer_rows: by the position
+        of the user and then by arrival
+    """
+    columns = [column for column in OFFER_SCHEMA]
+    offers = pd.DataFrame({column: [row[column] for row in rows] for column in columns + ['sequence']})
+    if users is not None:
+        position = pd.Categorical(offers['user_id'], categories=users).codes
+        offers = offers.loc[position >= 0]
+        offers = offers.iloc[np.lexsort((offers['sequence'], position[position >= 0]))]
+    offers = offers.loc[:, columns].reset_index(drop=True)
+    return apply_schema(offers, OFFER_SCHEMA)
+
+
+def _view_limit(offer):
+    """
+    Last hour a view counts: the end of the offer, or its completion unless it was completed in hour 0
+    """
+    if offer['completed'] and offer['complet_time'] != 0:
+        return min(offer['end_time'], offer['complet_time'])
+    return offer['end_time']
+
+
+def _window_end(offer):
+    if offer['completed'] and offer['complet_time'] != 0:
+        return offer['complet_time']
+    return offer['end_time']
+
+
+def _as_event(record):
+    """
+    Returns (user, event, time, offer id, amount) of a cleaned or raw transcript record
+    """
+    value = record.get('value') or {}
+    offer_id = record.get('offer_id', value.get('offer_id', value.get('offer id')))
+    amount = record.get('amount', value.get('amount', np.nan))
+    return record['id'] if 'id' in record else record['person'], record['event'], record['time'], offer_id, amount
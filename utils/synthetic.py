@@ -0,0 +1,133 @@
+import json
+import os
+
+import numpy as np
+
+from utils.lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+# hours at which offers are sent out in the Starbucks data, and the last hour of the experiment
+OFFER_WAVES = np.array([0, 168, 336, 408, 504, 576])
+MAX_TIME = 714
+# approximate rates of the Starbucks data, ~306k events for ~17k users
+EVENTS_PER_USER = 18
+RECEIVE_RATE = 0.75
+VIEW_RATE = 0.76
+COMPLETION_RATE = 0.55
+TRANSACTIONS_PER_USER = 8.2
+CHANNELS = ['email', 'mobile', 'social', 'web']
+
+
+def generate(n_events=306534, seed=0):
+    """
+    Generates raw portfolio, profile and transcript dataframes shaped like the Starbucks json files
+    :param n_events: approximate number of transcript events
+    :param seed: seed of the random generator
+    :return: (portfolio, profile, transcript)
+    """
+    rng = np.random.default_rng(seed)
+    portfolio = generate_portfolio(rng)
+    profile = generate_profile(max(1, int(round(n_events / EVENTS_PER_USER))), rng)
+    transcript = generate_transcript(portfolio, profile, rng)
+    return portfolio, profile, transcript
+
+
+def generate_portfolio(rng, n_offers=10):
+    """
+    Generates a portfolio of bogo, discount and informational offers
+    """
+    offer_type = np.resize(np.array(['bogo', 'discount', 'informational'], dtype=object), n_offers)
+    rng.shuffle(offer_type)
+    informational = offer_type == 'informational'
+    difficulty = np.where(informational, 0, rng.choice([5, 7, 10, 20], n_offers))
+    reward = np.where(informational, 0, np.where(offer_type == 'bogo', difficulty, rng.choice([2, 3, 5], n_offers)))
+    channels = [['email'] + [channel for channel in CHANNELS[1:] if rng.random() < 0.7] for _ in range(n_offers)]
+    return pd.DataFrame({'reward': reward,
+                         'channels': channels,
+                         'difficulty': difficulty,
+                         'duration': rng.choice([3.0, 4.0, 5.0, 7.0, 10.0], n_offers),
+                         'offer_type': offer_type,
+                         'id': _random_ids(rng, n_offers)})
+
+
+def generate_profile(n_users, rng):
+    """
+    Generates users with the gender, age and income distribution of the Starbucks data.
+    About 13% of the users have the default profile: no gender, age 118 and no income.
+    """
+    gender = rng.choice(np.array(['F', 'M', 'O', None], dtype=object), n_users, p=[0.36, 0.50, 0.012, 0.128])
+    default = pd.isna(gender)
+    member_since = pd.Timestamp('2013-07-29') + pd.to_timedelta(rng.integers(0, 1823, n_users), unit='D')
+    return pd.DataFrame({'gender': gender,
+                         'age': np.where(default, 118, np.clip(rng.normal(54, 17, n_users), 18, 101).astype(int)),
+                         'id': _random_ids(rng, n_users),
+                         'became_member_on': np.asarray(member_since.strftime('%Y%m%d')),
+                         'income': np.where(default, np.nan, rng.integers(30, 121, n_users) * 1000.0)})
+
+
+def generate_transcript(portfolio, profile, rng):
+    """
+    Generates the events of all users in the order of the Starbucks transcript, sorted by time.
+    Offers are received in waves at OFFER_WAVES. Views may come before or after the completion or after the offer
+    expired, completions can happen in the hour the offer was received and users can receive the same offer twice.
+    """
+    n_users = len(profile)
+    offer_ids = np.asarray(portfolio['id'], dtype=object)
+    durations = np.asarray(portfolio['duration']).astype(int) * 24
+    informational = np.asarray(portfolio['offer_type']) == 'informational'
+
+    user, wave = np.nonzero(rng.random((n_users, len(OFFER_WAVES))) < RECEIVE_RATE)
+    offer = rng.integers(0, len(portfolio), len(user))
+    start = OFFER_WAVES[wave]
+    duration = durations[offer]
+
+    is_viewed = rng.random(len(user)) < VIEW_RATE
+    view_time = start + (rng.random(len(user)) ** 2 * (duration + 48)).astype(int)
+    is_viewed &= view_time <= MAX_TIME
+    is_completed = (rng.random(len(user)) < COMPLETION_RATE) & ~informational[offer]
+    completion_time = start + (rng.random(len(user)) ** 2 * (duration + 1)).astype(int)
+    is_completed &= completion_time <= MAX_TIME
+
+    n_transactions = rng.poisson(TRANSACTIONS_PER_USER, n_users) * (rng.random(n_users) > 0.05)
+    transaction_user = np.repeat(np.arange(n_users), n_transactions)
+    transaction_time = rng.integers(0, MAX_TIME + 1, len(transaction_user))
+    amount = np.round(rng.lognormal(2.2, 1.0, len(transaction_user)), 2)
+
+    rewards = np.asarray(portfolio['reward']).astype(int)
+    values = ([{'offer id': offer_ids[k]} for k in offer] +
+              [{'offer id': offer_ids[k]} for k in offer[is_viewed]] +
+              [{'offer_id': offer_ids[k], 'reward': int(rewards[k])} for k in offer[is_completed]] +
+              [{'amount': float(a)} for a in amount])
+    events = np.repeat(['offer received', 'offer viewed', 'offer completed', 'transaction'],
+                       [len(user), is_viewed.sum(), is_completed.sum(), len(transaction_user)])
+    users = np.concatenate((user, user[is_viewed], user[is_completed], transaction_user))
+    times = np.concatenate((start, view_time[is_viewed], completion_time[is_completed], transaction_time))
+
+    order = np.argsort(times, kind='stable')
+    return pd.DataFrame({'person': np.asarray(profile['id'], dtype=object)[users[order]],
+                         'event': events[order].astype(object),
+                         'value': np.array(values, dtype=object)[order],
+                         'time': times[order]})
+
+
+def write_json(data_dir, portfolio, profile, transcript, chunksize=100000):
+    """
+    Writes the dataframes as json lines files readable by utils.loading.load_all
+    """
+    os.makedirs(data_dir, exist_ok=True)
+    portfolio.to_json(os.path.join(data_dir, 'portfolio.json'), orient='records', lines=True)
+    profile.to_json(os.path.join(data_dir, 'profile.json'), orient='records', lines=True)
+    with open(os.path.join(data_dir, 'transcript.json'), 'w') as f:
+        for start in range(0, len(transcript), chunksize):
+            chunk = transcript.iloc[start:start + chunksize]
+            f.writelines(json.dumps({'person': person, 'event': event, 'value': value, 'time': int(time)}) + '\n'
+                         for person, event, value, time in zip(chunk['person'], chunk['event'], chunk['value'],
+                                                               chunk['time']))
+
+
+def _random_ids(rng, n):
+    """
+    Returns n random 32 character hex ids
+    """
+    return np.array([bytes(row).hex() for row in rng.integers(0, 256, (n, 16), dtype=np.uint8)], dtype=object)
@@ -0,0 +1,130 @@
+"""
+Dense users x hours spend tensor.
+
+The transactions of every user are summed per hour into a float32 matrix with one row per user and one column per
+hour of the experiment, with boolean masks of the same shape for the hours inside any viewed offer window and inside
+the viewed windows of every offer type. Spendings then reduce along the hours:
+
+    tensor = build_spend_tensor(profile, transcript, offer_df)
+    spent_in_window = (tensor.spend * tensor.in_window).sum(axis=1, dtype=float)
+    cumulative = tensor.spend.cumsum(axis=1)
+
+With a directory the arrays are written as .npy files and returned memory-mapped, load_spend_tensor() maps them in
+other processes without copying.
+"""
+import os
+from collections import namedtuple
+
+import numpy as np
+
+from utils.build_matrices import group_transcript_by_user
+from utils.lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+OFFER_TYPES = ['bogo', 'discount', 'informational']
+
+# users: user id of every row, spend: float32 users x hours, in_window: bool users x hours,
+# in_type_window: dict of offer type to bool users x hours
+SpendTensor = namedtuple('SpendTensor', ['users', 'spend', 'in_window', 'in_type_window'])
+
+
+def build_spend_tensor(profile, transcript, offer_df, n_hours=None, directory=None):
+    """
+    Builds the spend tensor and the offer window masks.
+    An hour is in a window when it lies in [view time, view time + time_in_window] of a viewed offer, the windows
+    build_user_df uses for spent_in_window.
+    :param profile: cleaned profile dataframe, one row per user
+    :param transcript: cleaned transcript dataframe
+    :param offer_df: offer matrix built by build_offer_df
+    :param n_hours: number of hours, defaults to the time of the last event + 1
+    :param directory: directory to write memory-mapped .npy files to, the arrays are kept in memory if None
+    :return: SpendTensor
+    """
+    users = np.asarray(profile['id'].unique(), dtype=object)
+    if n_hours is None:
+        n_hours = int(transcript.loc[:, 'time'].max()) + 1
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+
+    user_transcripts, offsets = group_transcript_by_user(transcript, users)
+    event_users = np.repeat(np.arange(len(users)), np.diff(offsets))
+    times = np.asarray(user_transcripts['time'], dtype=np.int64)
+    is_transaction = (np.asarray(user_transcripts['event']) == 'transaction') & (times < n_hours)
+    cells = event_users[is_transaction] * n_hours + times[is_transaction]
+    spend = _new_array(directory, 'spend', (len(users), n_hours), np.float32)
+    spend[:] = np.bincount(cells, weights=np.asarray(user_transcripts['amount'], dtype=float)[is_transaction],
+                           minlength=spend.size).reshape(spend.shape)
+
+    offer_users = pd.Categorical(offer_df['user_id'], categories=users).codes.astype(np.int64)
+    starts = offer_df['view_time'].to_numpy(dtype=float, na_value=np.nan)
+    viewed = (offer_users >= 0) & ~np.isnan(starts)
+    offer_users = offer_users[viewed]
+    starts = starts[viewed].astype(np.int64)
+    ends = starts + np.asarray(offer_df['time_in_window'])[viewed]
+    offer_types = np.asarray(offer_df['offer_type'], dtype=object)[viewed]
+
+    in_window = _window_mask(_new_array(directory, 'in_window', spend.shape, bool), offer_users, starts, ends)
+    in_type_window = {}
+    for kind in OFFER_TYPES:
+        is_kind = offer_types == kind
+        in_type_window[kind] = _window_mask(_new_array(directory, 'in_' + kind, spend.shape, bool),
+                                            offer_users[is_kind], starts[is_kind], ends[is_kind])
+    if directory is not None:
+        np.save(os.path.join(directory, 'users.npy'), users.astype(str))
+        for array in [spend, in_window] + list(in_type_window.values()):
+            array.flush()
+    return SpendTensor(users, spend, in_window, in_type_window)
+
+
+def load_spend_tensor(directory, mmap_mode='r'):
+    """
+    Maps a spend tensor written by build_spend_tensor(directory=...)
+    :param mmap_mode: mode of np.load, 'r' shares the pages of the files read-only between processes
+    :return: SpendTensor
+    """
+    def load(name):
+        return np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode)
+    return SpendTensor(np.load(os.path.join(directory, 'users.npy')).astype(object), load('spend'),
+                       load('in_window'), {kind: load('in_' + kind) for kind in OFFER_TYPES})
+
+
+def spend_totals(tensor):
+    """
+    Returns the total spending and the spending in and out of the viewed offer windows of every user.
+    Overlapping windows are merged by the masks, so the spending in the windows of an offer type counts every
+    transaction once, unlike spent_in_<type> of build_user_df which adds up the windows.
+    :return: pd.DataFrame with user_id, spent_total, spent_in_window, spent_no_window and spent_in_<type>_windows
+    """
+    totals = pd.DataFrame({'user_id': tensor.users,
+                           'spent_total': tensor.spend.sum(axis=1, dtype=float),
+                           'spent_in_window': np.where(tensor.in_window, tensor.spend, 0).sum(axis=1, dtype=float),
+                           'spent_no_window': np.where(tensor.in_window, 0, tensor.spend).sum(axis=1, dtype=float)})
+    for kind, mask in tensor.in_type_window.items():
+        totals['spent_in_{}_windows'.format(kind)] = np.where(mask, tensor.spend, 0).sum(axis=1, dtype=float)
+    return totals
+
+
+def _new_array(directory, name, shape, dtype):
+    """
+    Returns a zeroed array, memory-mapped to <directory>/<name>.npy if directory is not None
+    """
+    if directory is None:
+        return np.zeros(shape, dtype=dtype)
+    return np.lib.format.open_memmap(os.path.join(directory, name + '.npy'), mode='w+', dtype=dtype, shape=shape)
+
+
+def _window_mask(mask, users, starts, ends):
+    """
+    Sets mask[user, start:end + 1] for every window, clipped to the hours of the mask.
+    The windows are added up as +1 at the start and -1 after the end of every window and a cumulative sum per user.
+    """
+    n_users, n_hours = mask.shape
+    starts = np.clip(starts, 0, n_hours)
+    stops = np.clip(ends + 1, 0, n_hours)
+    keep = starts < stops
+    counts = np.zeros(n_users * (n_hours + 1), dtype=np.int32)
+    np.add.at(counts, users[keep] * (n_hours + 1) + starts[keep], 1)
+    np.add.at(counts, users[keep] * (n_hours + 1) + stops[keep], -1)
+    mask[:] = np.cumsum(counts.reshape(n_users, n_hours + 1), axis=1)[:, :n_hours] > 0
+    return mask
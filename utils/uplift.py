@@ -0,0 +1,117 @@
+"""
+Uplift of the spending rate during offer windows, with bootstrap confidence intervals per segment.
+
+The spending rate in the windows of a segment is the spending in the viewed offer windows of its users divided by
+the time in the windows, the rate outside is the spending outside any window divided by the time outside. The
+uplift is rate_in / rate_out - 1. The users of every segment are resampled with replacement: each batch of
+resamples is one matrix of user indices, so the sums of all resamples of a batch are a single gather and sum.
+
+    segment_uplift(profile_expanded, by=['gender'])
+    segment_uplift(profile_expanded, by=['gender'], offer_df=offer_df)  # in-window rates per offer type
+"""
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from utils.cube import NO_GENDER
+from utils.lazy import lazy_import
+
+pd = lazy_import('pandas')
+
+# resamples x users of one index matrix, bounds the memory of a batch to a few tens of MB
+BATCH_ELEMENTS = 4000000
+COLUMNS = ['spent_in', 'time_in', 'spent_out', 'time_out']
+
+
+def segment_uplift(profile_expanded, by, offer_df=None, n_resamples=10000, confidence=0.95, seed=0, n_workers=1):
+    """
+    Estimates the uplift of every segment with a percentile bootstrap confidence interval.
+    :param profile_expanded: expanded profile built by build_user_df
+    :param by: list of profile_expanded columns defining the segments, e.g. ['gender'] or ['gender', 'age_group']
+    :param offer_df: offer matrix, if given the in-window spending and time are taken per offer type from the
+        amount_in_window and time_in_window of the offers, and offer_type is added to the segments
+    :param n_resamples: number of bootstrap resamples per segment
+    :param confidence: confidence level of the interval
+    :param seed: seed of the resampling, every segment gets its own stream so the result does not depend on n_workers
+    :param n_workers: number of worker processes, None for the number of CPUs
+    :return: pd.DataFrame indexed by the segments with n_users, rate_in, rate_out, uplift, uplift_low, uplift_high
+        and p_no_uplift, the share of resamples without a positive uplift
+    """
+    by = list(by)
+    units = uplift_units(profile_expanded, by, offer_df)
+    keys = by + (['offer_type'] if offer_df is not None else [])
+    groups = units.groupby(keys, sort=True, observed=True).indices
+    streams = np.random.SeedSequence(seed).spawn(len(groups))
+    values = units.loc[:, COLUMNS].to_numpy(dtype=float)
+    tasks = [(values[rows], n_resamples, confidence, stream) for rows, stream in zip(groups.values(), streams)]
+
+    if n_workers is None:
+        n_workers = os.cpu_count() or 1
+    if n_workers == 1:
+        results = [bootstrap_uplift(*task) for task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(bootstrap_uplift, *zip(*tasks)))
+
+    index = pd.MultiIndex.from_tuples([key if isinstance(key, tuple) else (key,) for key in groups], names=keys)
+    return pd.DataFrame(results, index=index)
+
+
+def uplift_units(profile_expanded, by, offer_df=None):
+    """
+    Returns the resampled units: one row per user, or per user and offer type received if offer_df is given, with
+    the segment columns and the spending and time in and out of the windows. Users without gender get gender N.
+    """
+    users = pd.DataFrame({column: np.asarray(profile_expanded[column]) for column in by})
+    if 'gender' in users.columns:
+        users['gender'] = users['gender'].astype(object).fillna(NO_GENDER)
+    users['user_id'] = np.asarray(profile_expanded['user_id'], dtype=object)
+    users['spent_out'] = np.asarray(profile_expanded['spent_no_window'], dtype=float)
+    users['time_out'] = np.asarray(profile_expanded['time_no_window'], dtype=float)
+    if offer_df is None:
+        users['spent_in'] = np.asarray(profile_expanded['spent_in_window'], dtype=float)
+        users['time_in'] = np.asarray(profile_expanded['time_in_window'], dtype=float)
+        return users
+    offers = pd.DataFrame({'user_id': np.asarray(offer_df['user_id'], dtype=object),
+                           'offer_type': np.asarray(offer_df['offer_type'], dtype=object),
+                           'spent_in': np.asarray(offer_df['amount_in_window'], dtype=float),
+                           'time_in': np.asarray(offer_df['time_in_window'], dtype=float)})
+    offers = offers.groupby(['user_id', 'offer_type'], sort=False).sum().reset_index()
+    return offers.merge(users, on='user_id')
+
+
+def bootstrap_uplift(values, n_resamples, confidence, seed):
+    """
+    Bootstraps the uplift of one segment
+    :param values: array of units x (spent_in, time_in, spent_out, time_out)
+    :param seed: seed or np.random.SeedSequence of the resampling
+    :return: dict of the estimate, its interval and the share of resamples without a positive uplift
+    """
+    rng = np.random.default_rng(seed)
+    n = len(values)
+    totals = values.sum(axis=0)
+    estimate = _uplift(totals)
+    columns = [np.ascontiguousarray(values[:, k]) for k in range(len(COLUMNS))]
+    resampled = np.empty(n_resamples)
+    batch = max(1, BATCH_ELEMENTS // max(n, 1))
+    for start in range(0, n_resamples, batch):
+        stop = min(start + batch, n_resamples)
+        index = rng.integers(0, n, size=(stop - start, n), dtype=np.int32)
+        # sums of every resample, one gather over the index matrix per column
+        resampled[start:stop] = _uplift(np.stack([column[index].sum(axis=1) for column in columns], axis=-1))
+    alpha = (1 - confidence) / 2
+    low, high = np.nanquantile(resampled, [alpha, 1 - alpha]) if n else (np.nan, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate_in, rate_out = totals[0] / totals[1], totals[2] / totals[3]
+    return {'n_users': n, 'rate_in': rate_in, 'rate_out': rate_out, 'uplift': estimate,
+            'uplift_low': low, 'uplift_high': high, 'p_no_uplift': np.mean(~(resampled > 0)) if n else np.nan}
+
+
+def _uplift(totals):
+    """
+    Returns rate in / rate out - 1 from the sums (spent_in, time_in, spent_out, time_out) along the last axis
+    """
+    totals = np.asarray(totals, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (totals[..., 0] / totals[..., 1]) / (totals[..., 2] / totals[..., 3]) - 1